@@ -0,0 +1,274 @@
+"""
+Benchmarks and parity reports for infer_donut
+
+Run from the parent folder of the plugin, for example:
+    python -m infer_donut.benchmark precision --images path/to/documents --precision bf16
+    python -m infer_donut.benchmark decode --images path/to/photos
+    python -m infer_donut.benchmark trim --images path/to/receipts
+    python -m infer_donut.benchmark attention --images path/to/documents
+    python -m infer_donut.benchmark state_cache --images path/to/documents --questions "what is the date;who signed"
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from infer_donut.model import DonutModel, canvas_scale, load_image
+from infer_donut.model_zoo import model_zoo, get_task_prompt
+
+
+def list_images(folder):
+    if os.path.isfile(folder):
+        return [folder]
+    extensions = ("*.jpg", "*.jpeg", "*.png", "*.tif", "*.tiff")
+    return sorted(path for ext in extensions for path in glob.glob(os.path.join(folder, ext)))
+
+
+def load_model(model_name, precision="fp32", device="cpu"):
+    model = DonutModel.from_pretrained(model_name, ignore_mismatched_sizes=True)
+    model.set_precision(precision, device)
+    return model.eval()
+
+
+def run_model(model, images, prompt):
+    outputs = []
+    with torch.no_grad():
+        for path in images:
+            start = time.perf_counter()
+            result = model.inference(image=Image.open(path), prompt=prompt)
+            outputs.append({
+                "prediction": result["predictions"][0],
+                "confidence": float(result["confidences"][0]),
+                "time": time.perf_counter() - start,
+            })
+    return outputs
+
+
+def precision_parity(args):
+    """
+    Compare predictions of every model-zoo task in the given precision against the fp32 reference
+    """
+    images = list_images(args.images)
+    if not images:
+        raise ValueError(f"No image found in {args.images}")
+
+    print(f"{'model':<50} {'exact match':>12} {'conf. delta':>12} {'fp32 (s)':>10} {args.precision + ' (s)':>10}")
+    for model_name, task_name in model_zoo.items():
+        prompt = get_task_prompt(task_name, args.question)
+        reference = run_model(load_model(model_name, "fp32", args.device), images, prompt)
+        candidate = run_model(load_model(model_name, args.precision, args.device), images, prompt)
+
+        matches = sum(ref["prediction"] == cand["prediction"] for ref, cand in zip(reference, candidate))
+        delta = sum(abs(ref["confidence"] - cand["confidence"]) for ref, cand in zip(reference, candidate))
+        ref_time = sum(ref["time"] for ref in reference) / len(images)
+        cand_time = sum(cand["time"] for cand in candidate) / len(images)
+        print(f"{model_name:<50} {matches / len(images):>12.2%} {delta / len(images):>12.4f} "
+              f"{ref_time:>10.2f} {cand_time:>10.2f}")
+
+
+def decode_benchmark(args):
+    """
+    Compare full-resolution decoding with decoding near the canvas size (model.load_image):
+    decode time, decoded pixel buffer size and mean difference once both are resized to the canvas scale
+    """
+    images = list_images(args.images)
+    if not images:
+        raise ValueError(f"No image found in {args.images}")
+
+    totals = np.zeros(4)
+    print(f"{'image':<40} {'full (ms)':>10} {'reduced (ms)':>13} {'full (MB)':>10} {'reduced (MB)':>13} {'diff':>8}")
+    for path in images:
+        start = time.perf_counter()
+        full = ImageOps.exif_transpose(Image.open(path)).convert("RGB")
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reduced = load_image(path, args.input_size, args.align_long_axis).convert("RGB")
+        reduced_time = time.perf_counter() - start
+
+        scale = canvas_scale(full.size, args.input_size, args.align_long_axis)
+        target = (max(1, round(full.width * scale)), max(1, round(full.height * scale)))
+        diff = np.abs(np.asarray(full.resize(target, Image.BICUBIC), dtype=np.float32) -
+                      np.asarray(reduced.resize(target, Image.BICUBIC), dtype=np.float32)).mean() / 255
+
+        sizes = [img.width * img.height * 3 / 2 ** 20 for img in (full, reduced)]
+        totals += [full_time, reduced_time] + sizes
+        print(f"{os.path.basename(path)[:40]:<40} {full_time * 1000:>10.1f} {reduced_time * 1000:>13.1f} "
+              f"{sizes[0]:>10.1f} {sizes[1]:>13.1f} {diff:>8.4f}")
+
+    totals /= len(images)
+    print(f"{'mean':<40} {totals[0] * 1000:>10.1f} {totals[1] * 1000:>13.1f} {totals[2]:>10.1f} {totals[3]:>13.1f}")
+
+
+def trim_parity(args):
+    """
+    Compare predictions with encoder padding tokens trimmed (trim_padding) against the full encoder sequence:
+    exact match, confidence delta, kept sequence length and inference time
+    """
+    images = list_images(args.images)
+    if not images:
+        raise ValueError(f"No image found in {args.images}")
+
+    model = load_model(args.model, args.precision, args.device)
+    prompt = get_task_prompt(model_zoo.get(args.model, args.task_name), args.question)
+
+    results = {}
+    for trim_padding in (False, True):
+        outputs = []
+        with torch.no_grad():
+            for path in images:
+                start = time.perf_counter()
+                output = model.inference(image=Image.open(path), prompt=prompt, trim_padding=trim_padding)
+                kept = output.get("encoder_sequence_length", {}).get("kept", 0)
+                outputs.append((output["predictions"][0], float(output["confidences"][0]), kept,
+                                time.perf_counter() - start))
+        results[trim_padding] = outputs
+
+    print(f"{'image':<40} {'match':>6} {'conf. delta':>12} {'kept tokens':>12} {'full (s)':>9} {'trim (s)':>9}")
+    for path, full, trimmed in zip(images, results[False], results[True]):
+        print(f"{os.path.basename(path)[:40]:<40} {str(full[0] == trimmed[0]):>6} {abs(full[1] - trimmed[1]):>12.4f} "
+              f"{trimmed[2]:>12} {full[3]:>9.2f} {trimmed[3]:>9.2f}")
+    matches = sum(full[0] == trimmed[0] for full, trimmed in zip(results[False], results[True]))
+    print(f"exact match: {matches / len(images):.2%}")
+
+
+def attention_parity(args):
+    """
+    Compare the sdpa attention backend with eager attention on the same model instance:
+    max absolute difference of encoder outputs and teacher-forced decoder logits (prompt tokens),
+    exact match of predictions and inference time. Exits with an error if a difference exceeds the tolerance
+    """
+    images = list_images(args.images)
+    if not images:
+        raise ValueError(f"No image found in {args.images}")
+
+    model = load_model(args.model, args.precision, args.device)
+    task_name = model_zoo.get(args.model, args.task_name)
+    prompt = get_task_prompt(task_name, args.question)
+    prompt_ids = model.decoder.tokenizer(prompt, add_special_tokens=False, return_tensors="pt")["input_ids"]
+    prompt_ids = prompt_ids.to(model.device)
+
+    results = {}
+    for backend in ("eager", "sdpa"):
+        if model.set_attention_backend(backend) != backend:
+            raise RuntimeError(f"{backend} attention backend is not available")
+
+        outputs = []
+        with torch.no_grad():
+            for path in images:
+                image_tensors = model.encoder.prepare_input(Image.open(path)).unsqueeze(0)
+                image_tensors = image_tensors.to(model.device, model.dtype)
+                encoder_output = model.encoder(image_tensors)
+                logits = model.decoder(input_ids=prompt_ids, encoder_hidden_states=encoder_output).logits
+                outputs.append((encoder_output.float(), logits.float()))
+        results[backend] = (outputs, run_model(model, images, prompt))
+
+    (eager_tensors, eager_runs), (sdpa_tensors, sdpa_runs) = results["eager"], results["sdpa"]
+    encoder_diff = max((ref[0] - cand[0]).abs().max().item() for ref, cand in zip(eager_tensors, sdpa_tensors))
+    logits_diff = max((ref[1] - cand[1]).abs().max().item() for ref, cand in zip(eager_tensors, sdpa_tensors))
+    matches = sum(ref["prediction"] == cand["prediction"] for ref, cand in zip(eager_runs, sdpa_runs))
+    eager_time = sum(run["time"] for run in eager_runs) / len(images)
+    sdpa_time = sum(run["time"] for run in sdpa_runs) / len(images)
+
+    print(f"{'encoder diff':>12} {'logits diff':>12} {'exact match':>12} {'eager (s)':>10} {'sdpa (s)':>10}")
+    print(f"{encoder_diff:>12.2e} {logits_diff:>12.2e} {matches / len(images):>12.2%} "
+          f"{eager_time:>10.2f} {sdpa_time:>10.2f}")
+    if encoder_diff > args.tolerance or logits_diff > args.tolerance:
+        sys.exit(f"sdpa attention differs from eager attention by more than {args.tolerance}")
+
+
+def state_cache_parity(args):
+    """
+    Compare inference with the decoder state cache against the uncached path: every question is asked on
+    every image, predictions and confidences must match, decoding time is reported per path
+    """
+    images = list_images(args.images)
+    if not images:
+        raise ValueError(f"No image found in {args.images}")
+
+    model = load_model(args.model, args.precision, args.device)
+    task_name = model_zoo.get(args.model, args.task_name)
+    prompts = [get_task_prompt(task_name, question) for question in args.questions.split(";")]
+
+    results = {}
+    for cached in (False, True):
+        model.enable_state_cache(len(images) if cached else 0)
+        outputs = []
+        with torch.no_grad():
+            for path in images:
+                image = Image.open(path)
+                for prompt in prompts:
+                    start = time.perf_counter()
+                    output = model.inference(image=image, prompt=prompt)
+                    outputs.append((output["predictions"][0], float(output["confidences"][0]),
+                                    time.perf_counter() - start))
+        results[cached] = outputs
+
+    matches = sum(ref[0] == cand[0] for ref, cand in zip(results[False], results[True]))
+    delta = max(abs(ref[1] - cand[1]) for ref, cand in zip(results[False], results[True]))
+    uncached_time = sum(output[2] for output in results[False]) / len(results[False])
+    cached_time = sum(output[2] for output in results[True]) / len(results[True])
+
+    print(f"{'exact match':>12} {'max conf. delta':>16} {'uncached (s)':>13} {'cached (s)':>11}")
+    print(f"{matches / len(results[False]):>12.2%} {delta:>16.2e} {uncached_time:>13.2f} {cached_time:>11.2f}")
+    if matches != len(results[False]):
+        sys.exit("cached decoder states change predictions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="infer_donut benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    precision_parser = subparsers.add_parser("precision", help="accuracy parity of a precision against fp32")
+    precision_parser.add_argument("--images", required=True, help="image file or folder of documents")
+    precision_parser.add_argument("--precision", default="bf16", choices=["bf16", "fp16"])
+    precision_parser.add_argument("--device", default="cpu")
+    precision_parser.add_argument("--question", default="what is the title", help="question for docvqa")
+    precision_parser.set_defaults(func=precision_parity)
+
+    decode_parser = subparsers.add_parser("decode", help="full vs reduced-resolution image decoding")
+    decode_parser.add_argument("--images", required=True, help="image file or folder of documents")
+    decode_parser.add_argument("--input_size", type=int, nargs=2, default=[2560, 1920], help="canvas height width")
+    decode_parser.add_argument("--align_long_axis", action="store_true")
+    decode_parser.set_defaults(func=decode_benchmark)
+
+    trim_parser = subparsers.add_parser("trim", help="prediction parity of padding trimming")
+    trim_parser.add_argument("--images", required=True, help="image file or folder of documents")
+    trim_parser.add_argument("--model", default="naver-clova-ix/donut-base-finetuned-cord-v2")
+    trim_parser.add_argument("--task_name", default="", help="task of a custom model")
+    trim_parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"])
+    trim_parser.add_argument("--device", default="cpu")
+    trim_parser.add_argument("--question", default="what is the title", help="question for docvqa")
+    trim_parser.set_defaults(func=trim_parity)
+
+    attention_parser = subparsers.add_parser("attention", help="numerical parity of sdpa against eager attention")
+    attention_parser.add_argument("--images", required=True, help="image file or folder of documents")
+    attention_parser.add_argument("--model", default="naver-clova-ix/donut-base-finetuned-docvqa")
+    attention_parser.add_argument("--task_name", default="", help="task of a custom model")
+    attention_parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"])
+    attention_parser.add_argument("--device", default="cpu")
+    attention_parser.add_argument("--question", default="what is the title", help="question for docvqa")
+    attention_parser.add_argument("--tolerance", type=float, default=1e-3, help="maximum absolute difference")
+    attention_parser.set_defaults(func=attention_parity)
+
+    state_parser = subparsers.add_parser("state_cache", help="parity and speed of the decoder state cache")
+    state_parser.add_argument("--images", required=True, help="image file or folder of documents")
+    state_parser.add_argument("--model", default="naver-clova-ix/donut-base-finetuned-docvqa")
+    state_parser.add_argument("--task_name", default="", help="task of a custom model")
+    state_parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"])
+    state_parser.add_argument("--device", default="cpu")
+    state_parser.add_argument("--questions", default="what is the title;what is the date",
+                              help="docvqa questions separated by ;")
+    state_parser.set_defaults(func=state_cache_parity)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import time
+
+import numpy as np
+
+
+def frame_signature(img, size=32):
+    # Cheap perceptual signature: grayscale, strided subsampling then block mean to size x size,
+    # mean-centered so that global brightness changes (auto exposure) are ignored
+    height, width = img.shape[:2]
+    step = max(1, min(height, width) // (size * 8))
+    small = img[::step, ::step]
+    if small.ndim == 3:
+        small = small.mean(axis=2)
+
+    rows = small.shape[0] // size * size
+    cols = small.shape[1] // size * size
+    if rows == 0 or cols == 0:
+        return small.astype(np.float32) / 255.0
+
+    blocks = small[:rows, :cols].reshape(size, rows // size, size, cols // size).mean(axis=(1, 3))
+    blocks = blocks.astype(np.float32) / 255.0
+    return blocks - blocks.mean()
+
+
+# --------------------
+# - Reuse the last prediction while the document in front of the camera does not change
+# --------------------
+class FrameDeduplicator:
+
+    def __init__(self, threshold=0.02, max_rate=0.0):
+        # threshold: mean absolute signature difference (0-1) under which a frame is considered unchanged
+        # max_rate: maximum number of inferences per second, changed frames are throttled above it (0: no limit)
+        self.threshold = threshold
+        self.max_rate = max_rate
+        self.reset()
+
+    def reset(self):
+        self.signature = None
+        self.result = None
+        self.key = None
+        self.last_inference = 0.0
+        self.frames = 0
+        self.reused = 0
+
+    def lookup(self, img, key=None):
+        # Returns (previous result or None if inference is needed, signature of the frame)
+        # key: identity of the options producing the result, a change always requires a new inference
+        self.frames += 1
+        signature = frame_signature(img)
+        if self.result is None or key != self.key or signature.shape != self.signature.shape:
+            return None, signature
+
+        changed = float(np.abs(signature - self.signature).mean()) >= self.threshold
+        throttled = self.max_rate > 0 and time.perf_counter() - self.last_inference < 1.0 / self.max_rate
+        if changed and not throttled:
+            return None, signature
+
+        self.reused += 1
+        return copy.deepcopy(self.result), signature
+
+    def update(self, signature, result, key=None):
+        self.signature = signature
+        self.result = copy.deepcopy(result)
+        self.key = key
+        self.last_inference = time.perf_counter()
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "reused": self.reused,
+            "reuse_rate": self.reused / self.frames if self.frames else 0.0,
+        }
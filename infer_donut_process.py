@@ -17,12 +17,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
+import os
 from ikomia import core, dataprocess
 from ikomia.utils import strtobool
-from infer_donut.model import DonutModel
+from infer_donut.model_loader import ModelConfig, model_loader
+from infer_donut.metrics import RunMetrics, LoggerSink, PrometheusFileSink, CallbackSink
+from infer_donut.result_cache import ResultCache
+from infer_donut.frame_dedup import FrameDeduplicator
 import torch
 from PIL import Image
-from infer_donut.model_zoo import model_zoo
+from infer_donut.model_zoo import model_zoo, get_task_prompt, cascade_classifier, parse_cascade_routes
 
 
 # --------------------
@@ -38,8 +42,55 @@ class InferDonutParam(core.CWorkflowTaskParam):
         self.task_name = ""
         self.cuda = torch.cuda.is_available()
         self.prompt = "what is the title"
+        # inference precision: fp32, bf16 (CPU or CUDA) or fp16 (CUDA only, fp32 on CPU)
+        self.precision = "fp16"
+        # attention implementation: eager or sdpa (fused scaled_dot_product_attention, PyTorch >= 2.0)
+        self.attention_backend = "eager"
         # used only with Ikomia STUDIO to store custom train browser's content
         self.custom_model_folder = ""
+        # compile encoder and decoder step with torch.compile at model load (PyTorch >= 2.0)
+        self.torch_compile = False
+        # folder where compiled artifacts are cached and reused across processes
+        self.compile_cache_folder = ""
+        # synthetic inference at model load (always done when torch_compile is True)
+        self.warmup = False
+        # restrict the decoder output projection to the tokens of the task (sliced once at load)
+        self.vocab_shortlist = False
+        # calibration corpus of expected outputs (text, JSON or Donut metadata.jsonl), special tokens only if empty
+        self.shortlist_corpus = ""
+        self.shortlist_min_count = 1
+        # number of recent images whose encoder output, cross-attention and prompt prefix states are reused (0: off)
+        self.state_cache_size = 0
+        # cascade mode: classify with rvlcdip, then extract with the model routed to the document class
+        self.cascade = False
+        # routes "class=model_name;class=model_name" (model zoo names), default routes if empty
+        self.cascade_routes = ""
+        # drop encoder tokens lying entirely in the canvas padding before decoding
+        self.trim_padding = False
+        # field localization from cross-attentions: none, boxes or heatmaps (boxes and heatmaps)
+        self.localization = "none"
+        # multi-page documents: paths of the pages following the input image, separated by ";"
+        self.pages = ""
+        # number of pages encoded and decoded together
+        self.page_batch_size = 4
+        # skip the remaining pages once an answer reaches this confidence (0: all pages are processed)
+        self.page_confidence_threshold = 0.0
+        # video/camera streams: reuse the previous prediction while frames do not change
+        self.stream_mode = False
+        # mean absolute difference (0-1) of frame signatures above which inference is run again
+        self.stream_threshold = 0.02
+        # maximum inferences per second in stream mode (0: no limit)
+        self.stream_max_rate = 0.0
+        # persistent result cache (disabled if cache_folder is empty)
+        self.cache_folder = ""
+        # entry lifetime in seconds (0: never expires)
+        self.cache_ttl = 86400
+        self.cache_max_size_mb = 512
+        # metrics export: none, logger or prometheus (text file written to metrics_file)
+        self.metrics_sink = "logger"
+        self.metrics_file = ""
+        # add run metrics to the output dictionary (key "metrics")
+        self.attach_metrics = False
         self.update = False
 
     def set_values(self, param_map):
@@ -47,14 +98,68 @@ class InferDonutParam(core.CWorkflowTaskParam):
         # Parameters values are stored as string and accessible like a python dict
         if (self.model_name != param_map["model_name"] or
                 self.task_name != param_map["task_name"] or
-                self.cuda != strtobool(param_map["cuda"])):
+                self.cuda != strtobool(param_map["cuda"]) or
+                self.precision != param_map["precision"] or
+                self.attention_backend != param_map["attention_backend"] or
+                self.torch_compile != strtobool(param_map["torch_compile"]) or
+                self.warmup != strtobool(param_map["warmup"]) or
+                self.cascade != strtobool(param_map["cascade"]) or
+                self.vocab_shortlist != strtobool(param_map["vocab_shortlist"]) or
+                self.shortlist_corpus != param_map["shortlist_corpus"] or
+                self.shortlist_min_count != int(param_map["shortlist_min_count"])):
             self.update = True
+            preload = True
+        else:
+            preload = False
 
         self.model_name = param_map["model_name"]
         self.task_name = param_map["task_name"]
         self.prompt = param_map["prompt"]
         self.cuda = strtobool(param_map["cuda"])
+        self.precision = param_map["precision"]
+        self.attention_backend = param_map["attention_backend"]
         self.custom_model_folder = param_map["custom_model_folder"]
+        self.torch_compile = strtobool(param_map["torch_compile"])
+        self.compile_cache_folder = param_map["compile_cache_folder"]
+        self.warmup = strtobool(param_map["warmup"])
+        self.vocab_shortlist = strtobool(param_map["vocab_shortlist"])
+        self.shortlist_corpus = param_map["shortlist_corpus"]
+        self.shortlist_min_count = int(param_map["shortlist_min_count"])
+        self.state_cache_size = int(param_map["state_cache_size"])
+        self.cascade = strtobool(param_map["cascade"])
+        self.cascade_routes = param_map["cascade_routes"]
+        self.trim_padding = strtobool(param_map["trim_padding"])
+        self.localization = param_map["localization"]
+        self.pages = param_map["pages"]
+        self.page_batch_size = int(param_map["page_batch_size"])
+        self.page_confidence_threshold = float(param_map["page_confidence_threshold"])
+        self.stream_mode = strtobool(param_map["stream_mode"])
+        self.stream_threshold = float(param_map["stream_threshold"])
+        self.stream_max_rate = float(param_map["stream_max_rate"])
+        self.cache_folder = param_map["cache_folder"]
+        self.cache_ttl = int(param_map["cache_ttl"])
+        self.cache_max_size_mb = int(param_map["cache_max_size_mb"])
+        self.metrics_sink = param_map["metrics_sink"]
+        self.metrics_file = param_map["metrics_file"]
+        self.attach_metrics = strtobool(param_map["attach_metrics"])
+
+        if preload:
+            self.preload()
+
+    def get_model_config(self, model_name=None):
+        model_name = model_name or self.model_name
+        device = "cuda" if torch.cuda.is_available() and self.cuda else "cpu"
+        task_name = model_zoo.get(model_name, self.task_name)
+        return ModelConfig(model_name, task_name, device, self.precision, self.attention_backend,
+                           self.torch_compile, self.compile_cache_folder, self.warmup,
+                           self.vocab_shortlist, self.shortlist_corpus, self.shortlist_min_count)
+
+    def get_pages(self):
+        return [path.strip() for path in self.pages.split(";") if path.strip() != ""]
+
+    def preload(self):
+        # Start loading the model matching current values in background, run() waits for it only if needed
+        model_loader.preload(self.get_model_config(cascade_classifier if self.cascade else None))
 
     def get_values(self):
         # Send parameters values to Ikomia application
@@ -64,7 +169,32 @@ class InferDonutParam(core.CWorkflowTaskParam):
             "task_name": self.task_name,
             "prompt": self.prompt,
             "cuda": str(self.cuda),
-            "custom_model_folder": self.custom_model_folder
+            "precision": self.precision,
+            "attention_backend": self.attention_backend,
+            "custom_model_folder": self.custom_model_folder,
+            "torch_compile": str(self.torch_compile),
+            "compile_cache_folder": self.compile_cache_folder,
+            "warmup": str(self.warmup),
+            "vocab_shortlist": str(self.vocab_shortlist),
+            "shortlist_corpus": self.shortlist_corpus,
+            "shortlist_min_count": str(self.shortlist_min_count),
+            "state_cache_size": str(self.state_cache_size),
+            "cascade": str(self.cascade),
+            "cascade_routes": self.cascade_routes,
+            "trim_padding": str(self.trim_padding),
+            "localization": self.localization,
+            "pages": self.pages,
+            "page_batch_size": str(self.page_batch_size),
+            "page_confidence_threshold": str(self.page_confidence_threshold),
+            "stream_mode": str(self.stream_mode),
+            "stream_threshold": str(self.stream_threshold),
+            "stream_max_rate": str(self.stream_max_rate),
+            "cache_folder": self.cache_folder,
+            "cache_ttl": str(self.cache_ttl),
+            "cache_max_size_mb": str(self.cache_max_size_mb),
+            "metrics_sink": self.metrics_sink,
+            "metrics_file": self.metrics_file,
+            "attach_metrics": str(self.attach_metrics)
         }
         return param_map
 
@@ -78,6 +208,13 @@ class InferDonut(dataprocess.C2dImageTask):
     def __init__(self, name, param):
         dataprocess.C2dImageTask.__init__(self, name)
         self.model = None
+        self.model_config = None
+        self.cascade_models = {}
+        self.frame_dedup = FrameDeduplicator()
+        self.metrics_sinks = []
+        self.prometheus_sink = None
+        self.result_cache = None
+        self.reported_loads = set()
         self.add_output(dataprocess.DataDictIO())
 
         # Create parameters class
@@ -91,17 +228,237 @@ class InferDonut(dataprocess.C2dImageTask):
         # This is handled by the main progress bar of Ikomia application
         return 1
 
-    def infer(self, img, task_name, question):
-        img = Image.fromarray(img)
-        if task_name == "docvqa":
-            output = self.model.inference(
-                image=img,
-                prompt=f"<s_{task_name}><s_question>{question.lower()}</s_question><s_answer>",
-            )["predictions"][0]
+    def add_metrics_sink(self, sink):
+        # Register a custom sink: any object exposing export(metrics: dict)
+        self.metrics_sinks.append(sink)
+
+    def set_metrics_callback(self, callback):
+        self.add_metrics_sink(CallbackSink(callback))
+
+    def get_metrics_sinks(self, param):
+        sinks = list(self.metrics_sinks)
+        if param.metrics_sink == "logger":
+            sinks.append(LoggerSink())
+        elif param.metrics_sink == "prometheus" and param.metrics_file != "":
+            if self.prometheus_sink is None or self.prometheus_sink.path != param.metrics_file:
+                self.prometheus_sink = PrometheusFileSink(param.metrics_file)
+            sinks.append(self.prometheus_sink)
+        return sinks
+
+    def get_result_cache(self, param):
+        if param.cache_folder == "":
+            return None
+        if (self.result_cache is None or self.result_cache.folder != param.cache_folder or
+                self.result_cache.ttl != param.cache_ttl or
+                self.result_cache.max_size != param.cache_max_size_mb * 2 ** 20):
+            self.result_cache = ResultCache(param.cache_folder, param.cache_ttl, param.cache_max_size_mb)
+        return self.result_cache
+
+    @staticmethod
+    def get_model_version(model_name):
+        # Local (custom) models can be retrained in the same folder: identify them by their files
+        if not os.path.isdir(model_name):
+            return None
+        version = []
+        for file_name in sorted(os.listdir(model_name)):
+            if file_name == "config.json" or file_name.endswith((".bin", ".safetensors", ".pt", ".pth")):
+                stat = os.stat(os.path.join(model_name, file_name))
+                version.append((file_name, stat.st_mtime_ns, stat.st_size))
+        return version
+
+    def get_output_identity(self, param):
+        # Everything but the document that changes the output: models, task, prompt and options
+        # (DonutModel.from_pretrained pins the "official" revision of hub models)
+        if param.cascade:
+            model = {"classifier": cascade_classifier, "routes": parse_cascade_routes(param.cascade_routes)}
         else:
-            output = self.model.inference(image=img, prompt=f"<s_{task_name}>")["predictions"][0]
-            
-        return output
+            model = param.model_name
+        identity = {
+            "model": model,
+            "model_version": self.get_model_version(param.model_name) if not param.cascade else None,
+            "task": param.task_name,
+            "prompt": param.prompt,
+            "precision": param.precision,
+            "attention_backend": param.attention_backend,
+            "vocab_shortlist": param.vocab_shortlist,
+            "trim_padding": param.trim_padding,
+            "localization": param.localization,
+        }
+        if param.vocab_shortlist:
+            # the shortlist depends on the corpus content, identified as the pages below
+            corpus = param.shortlist_corpus
+            if os.path.isfile(corpus):
+                corpus = (corpus, os.path.getmtime(corpus), os.path.getsize(corpus))
+            identity["shortlist_corpus"] = corpus
+            identity["shortlist_min_count"] = param.shortlist_min_count
+        if param.get_pages() and not param.cascade:
+            # additional pages are identified by path and modification state
+            identity["pages"] = [(path, os.path.getmtime(path), os.path.getsize(path)) for path in param.get_pages()]
+            identity["page_confidence_threshold"] = param.page_confidence_threshold
+        return identity
+
+    def get_model(self, config, metrics):
+        # Wait for the background load of this configuration only if it is not finished yet
+        future = model_loader.preload(config)
+        if not future.done():
+            with metrics.stage("load_wait"):
+                future.result()
+
+        model, timings = future.result()
+        # load/compile/warmup ran in background: reported once, apart from the stages of the run
+        if config not in self.reported_loads:
+            self.reported_loads.add(config)
+            metrics.add_background_timings(config.model_name, timings)
+        return model
+
+    def update_model(self, param, metrics):
+        # The previous model keeps being used by other tasks until this one is ready
+        config = param.get_model_config()
+        self.model = self.get_model(config, metrics)
+        self.model_config = config
+
+        param.task_name = config.task_name
+        if param.task_name != 'docvqa' and param.prompt != '':
+            print("Parameter prompt is only available for document visual question answering task.")
+
+        param.update = False
+
+    def release_models(self, param):
+        # Keep references only to the models of the current mode and configuration, so that unused ones can be freed
+        if param.cascade:
+            self.model = None
+            self.model_config = None
+            model_names = [cascade_classifier] + list(parse_cascade_routes(param.cascade_routes).values())
+            configs = {param.get_model_config(model_name) for model_name in model_names}
+            self.cascade_models = {config: model for config, model in self.cascade_models.items() if config in configs}
+        else:
+            self.cascade_models = {}
+
+    def get_cascade_model(self, param, model_name, metrics):
+        config = param.get_model_config(model_name)
+        if config not in self.cascade_models:
+            self.cascade_models[config] = self.get_model(config, metrics)
+        return self.cascade_models[config]
+
+    def prepare_image(self, model, img, image_cache):
+        # Resize and pad once per canvas configuration, models sharing it (cascade mode) reuse the tensor
+        key = (tuple(model.config.input_size), model.config.align_long_axis)
+        if key not in image_cache:
+            image_cache[key] = model.encoder.prepare_input(img, return_content_region=True)
+        return image_cache[key]
+
+    def infer(self, model, img, task_name, question, param, metrics, image_cache, prefix=""):
+        with metrics.stage(prefix + "preprocess"):
+            image_tensor, content_region = self.prepare_image(model, img, image_cache)
+
+        # the state cache lives on the model, shared by the tasks using the same configuration:
+        # it only grows to the largest requested size so that tasks never wipe each other's states
+        max_images = model.state_cache.max_images if model.state_cache is not None else 0
+        if param.state_cache_size > max_images:
+            model.enable_state_cache(param.state_cache_size)
+
+        result = model.inference(image_tensors=image_tensor.unsqueeze(0),
+                                 content_region=content_region,
+                                 prompt=get_task_prompt(task_name, question),
+                                 return_timings=True,
+                                 return_heatmaps=param.localization != "none",
+                                 trim_padding=param.trim_padding,
+                                 use_state_cache=param.state_cache_size > 0)
+        metrics.add_timings(result["timings"], prefix)
+        metrics.add_tokens(result["num_tokens"])
+        if "vocab_shortlist" in result:
+            metrics.set_counter(prefix + "vocab_shortlist", result["vocab_shortlist"])
+        if "encoder_sequence_length" in result:
+            metrics.set_counter(prefix + "encoder_tokens_total", result["encoder_sequence_length"]["total"])
+            metrics.set_counter(prefix + "encoder_tokens_kept", result["encoder_sequence_length"]["kept"])
+        if "state_cache" in result:
+            metrics.record_cache(prefix + "encoder_state", result["state_cache"]["encoder"])
+            if result["state_cache"]["prefix_tokens"] + result["state_cache"]["prefill_tokens"] > 0:
+                # single-token prompts have no prefix to reuse
+                metrics.record_cache(prefix + "prompt_prefix", result["state_cache"]["prefix_tokens"] > 0)
+            metrics.set_counter(prefix + "prefill_tokens", result["state_cache"]["prefill_tokens"])
+
+        output = result["predictions"][0]
+        confidence = float(result["confidences"][0])
+        if param.localization != "none":
+            output["localization"] = self.get_localization(result["heatmaps"][0], param)
+
+        return output, confidence
+
+    @staticmethod
+    def get_localization(fields, param):
+        localization = []
+        for field in fields:
+            field_output = {"field": field["field"], "box": [round(v, 1) for v in field["box"]]}
+            if param.localization == "heatmaps":
+                field_output["heatmap"] = field["heatmap"].numpy().round(4).tolist()
+            localization.append(field_output)
+        return localization
+
+    def infer_pages(self, img, param, metrics):
+        # Multi-page documents: the input image is the first page, answers of all pages are ranked by confidence
+        result = self.model.inference_pages([img] + param.get_pages(),
+                                            get_task_prompt(param.task_name, param.prompt),
+                                            batch_size=param.page_batch_size,
+                                            confidence_threshold=param.page_confidence_threshold or None,
+                                            return_timings=True,
+                                            return_heatmaps=param.localization != "none",
+                                            trim_padding=param.trim_padding)
+        metrics.add_timings(result["timings"])
+        metrics.add_tokens(result["num_tokens"])
+        metrics.set_counter("pages_total", result["num_pages"])
+        metrics.set_counter("pages_processed", result["processed_pages"])
+
+        output = dict(result["prediction"])
+        output["page"] = result["page"]
+        if param.localization != "none":
+            output["localization"] = self.get_localization(result["candidates"][0]["heatmaps"], param)
+        output["candidates"] = [{"page": candidate["page"],
+                                 "prediction": candidate["prediction"],
+                                 "confidence": candidate["confidence"]} for candidate in result["candidates"]]
+        return output, result["confidence"]
+
+    def infer_cascade(self, img, param, metrics, image_cache):
+        # Classify first, then extract only documents whose class is routed to an extractor
+        classifier = self.get_cascade_model(param, cascade_classifier, metrics)
+        output, confidence = self.infer(classifier, img, model_zoo[cascade_classifier], "", param, metrics,
+                                        image_cache, "classify_")
+
+        model_name = parse_cascade_routes(param.cascade_routes).get(output.get("class"))
+        metrics.set_counter("cascade_extracted", model_name is not None)
+        if model_name is not None:
+            extractor = self.get_cascade_model(param, model_name, metrics)
+            output["extraction_model"] = model_name
+            output["extraction"], confidence = self.infer(extractor, img, model_zoo[model_name], param.prompt,
+                                                          param, metrics, image_cache, "extract_")
+        return output, confidence
+
+    def predict(self, img, param, metrics, output_identity):
+        result_cache = self.get_result_cache(param)
+        if result_cache is not None:
+            with metrics.stage("cache_lookup"):
+                cache_key = ResultCache.make_key(img, **output_identity)
+                cached = result_cache.get(cache_key)
+            metrics.record_cache("result", cached is not None)
+            if cached is not None:
+                return cached["prediction"]
+
+        # decoded image shared by all stages of the run
+        image_cache = {}
+        pil_img = Image.fromarray(img)
+        with torch.no_grad():
+            if param.cascade:
+                result, confidence = self.infer_cascade(pil_img, param, metrics, image_cache)
+            elif param.get_pages():
+                result, confidence = self.infer_pages(pil_img, param, metrics)
+            else:
+                result, confidence = self.infer(self.model, pil_img, param.task_name, param.prompt, param,
+                                                metrics, image_cache)
+
+        if result_cache is not None:
+            with metrics.stage("cache_store"):
+                result_cache.put(cache_key, {"prediction": result, "confidence": confidence})
+        return result
 
     def run(self):
         # Core function of your process
@@ -109,31 +466,42 @@ class InferDonut(dataprocess.C2dImageTask):
         self.begin_task_run()
 
         param = self.get_param_object()
+        metrics = RunMetrics(param.model_name, param.task_name, param.cuda)
 
-        if self.model is None or param.update:
-            print("Loading model...")
-            self.model = DonutModel.from_pretrained(param.model_name, ignore_mismatched_sizes=True)
-            print("Model loaded.")
+        self.release_models(param)
+        if param.cascade:
+            metrics.task_name = "cascade"
+        elif self.model is None or param.update or param.get_model_config() != self.model_config:
+            self.update_model(param, metrics)
+            metrics.task_name = param.task_name
 
-            if torch.cuda.is_available() and param.cuda:
-                self.model.half()
-                self.model.to("cuda")
-
-            self.model.eval()
+        img_input = self.get_input(0)
+        img = img_input.get_image()
+        output_identity = self.get_output_identity(param)
 
-            if param.model_name in model_zoo:
-                param.task_name = model_zoo[param.model_name]
-            if param.task_name != 'docvqa' and param.prompt != '':
-                print("Parameter prompt is only available for document visual question answering task.")
+        result = None
+        if param.stream_mode:
+            # reuse the previous prediction while the frame does not change significantly
+            self.frame_dedup.threshold = param.stream_threshold
+            self.frame_dedup.max_rate = param.stream_max_rate
+            with metrics.stage("stream_lookup"):
+                result, signature = self.frame_dedup.lookup(img, output_identity)
+            metrics.record_cache("stream", result is not None)
+            metrics.set_counter("stream", self.frame_dedup.stats())
 
-            param.update = False
+        if result is None:
+            result = self.predict(img, param, metrics, output_identity)
+            if param.stream_mode:
+                self.frame_dedup.update(signature, result, output_identity)
 
-        img_input = self.get_input(0)
-        img = img_input.get_image()
+        run_metrics = metrics.to_dict()
+        for sink in self.get_metrics_sinks(param):
+            sink.export(run_metrics)
+        if param.attach_metrics:
+            result["metrics"] = run_metrics
 
         data_output = self.get_output(1)
-        with torch.no_grad():
-            data_output.data = self.infer(img, param.task_name, param.prompt)
+        data_output.data = result
 
         # Step progress bar (Ikomia Studio):
         self.emit_step_progress()
@@ -150,6 +518,15 @@ class InferDonutFactory(dataprocess.CTaskFactory):
 
     def __init__(self):
         dataprocess.CTaskFactory.__init__(self)
+        # Start loading models listed in INFER_DONUT_PRELOAD (comma-separated names) in background,
+        # the loader keeps at least as many models so that none of them is evicted while loading
+        preload = [name.strip() for name in os.environ.get("INFER_DONUT_PRELOAD", "").split(",") if name.strip()]
+        model_loader.max_models = max(model_loader.max_models, len(preload))
+        for model_name in preload:
+            param = InferDonutParam()
+            param.model_name = model_name
+            param.preload()
+
         # Set process information as string here
         self.info.name = "infer_donut"
         self.info.short_description = "OCR-free model for document understanding"
@@ -42,6 +42,12 @@ class InferDonutWidget(core.CWorkflowTaskWidget):
 
         # Save current state
         self.cuda = self.parameters.cuda
+        self.precision = self.parameters.precision
+        self.attention_backend = self.parameters.attention_backend
+        self.torch_compile = self.parameters.torch_compile
+        self.warmup = self.parameters.warmup
+        self.cascade = self.parameters.cascade
+        self.shortlist = self.get_shortlist()
         self.model_name = self.parameters.model_name
 
         # Create layout : QGridLayout by default
@@ -71,17 +77,134 @@ class InferDonutWidget(core.CWorkflowTaskWidget):
         self.check_cuda = pyqtutils.append_check(self.grid_layout, "Cuda", self.parameters.cuda and cuda.is_available())
         self.check_cuda.setEnabled(cuda.is_available())
 
+        # Precision
+        self.combo_precision = pyqtutils.append_combo(self.grid_layout, "Precision")
+        for precision in ["fp32", "bf16", "fp16"]:
+            self.combo_precision.addItem(precision)
+        self.combo_precision.setCurrentText(self.parameters.precision)
+
+        # Attention backend
+        self.combo_attention = pyqtutils.append_combo(self.grid_layout, "Attention backend")
+        for backend in ["eager", "sdpa"]:
+            self.combo_attention.addItem(backend)
+        self.combo_attention.setCurrentText(self.parameters.attention_backend)
+
+        # Vocabulary shortlist
+        self.check_vocab_shortlist = pyqtutils.append_check(self.grid_layout, "Vocabulary shortlist",
+                                                            self.parameters.vocab_shortlist)
+        self.browse_shortlist_corpus = pyqtutils.append_browse_file(self.grid_layout, "Shortlist corpus",
+                                                                    self.parameters.shortlist_corpus)
+        self.spin_shortlist_min_count = pyqtutils.append_spin(self.grid_layout, "Shortlist min count",
+                                                              self.parameters.shortlist_min_count, min=1, max=1000000)
+
+        # Cascade
+        self.check_cascade = pyqtutils.append_check(self.grid_layout, "Cascade (classify then extract)",
+                                                    self.parameters.cascade)
+        self.edit_cascade_routes = pyqtutils.append_edit(self.grid_layout, "Cascade routes (class=model;...)",
+                                                         self.parameters.cascade_routes)
+
+        # Compilation and warmup
+        self.check_compile = pyqtutils.append_check(self.grid_layout, "Compile model (torch.compile)",
+                                                    self.parameters.torch_compile)
+        self.browse_compile_cache = pyqtutils.append_browse_file(self.grid_layout, "Compile cache folder",
+                                                                 self.parameters.compile_cache_folder,
+                                                                 mode=QFileDialog.Directory)
+        self.check_warmup = pyqtutils.append_check(self.grid_layout, "Warmup at load", self.parameters.warmup)
+
+        # Decoder state cache
+        self.spin_state_cache_size = pyqtutils.append_spin(self.grid_layout, "State cache images (0: off)",
+                                                           self.parameters.state_cache_size, min=0, max=64)
+
+        # Padding trimming
+        self.check_trim_padding = pyqtutils.append_check(self.grid_layout, "Trim padding tokens",
+                                                         self.parameters.trim_padding)
+
+        # Multi-page documents
+        self.edit_pages = pyqtutils.append_edit(self.grid_layout, "Additional pages (path;path...)",
+                                                self.parameters.pages)
+        self.spin_page_batch_size = pyqtutils.append_spin(self.grid_layout, "Page batch size",
+                                                          self.parameters.page_batch_size, min=1, max=64)
+        self.spin_page_threshold = pyqtutils.append_double_spin(self.grid_layout, "Page early exit confidence",
+                                                                self.parameters.page_confidence_threshold,
+                                                                min=0.0, max=1.0, step=0.05, decimals=2)
+
+        # Stream mode
+        self.check_stream_mode = pyqtutils.append_check(self.grid_layout, "Stream mode (reuse unchanged frames)",
+                                                        self.parameters.stream_mode)
+        self.spin_stream_threshold = pyqtutils.append_double_spin(self.grid_layout, "Frame change threshold",
+                                                                  self.parameters.stream_threshold,
+                                                                  min=0.0, max=1.0, step=0.005, decimals=3)
+        self.spin_stream_max_rate = pyqtutils.append_double_spin(self.grid_layout, "Max inferences/s (0: no limit)",
+                                                                 self.parameters.stream_max_rate,
+                                                                 min=0.0, max=100.0, step=0.1, decimals=2)
+
+        # Result cache
+        self.browse_cache_folder = pyqtutils.append_browse_file(self.grid_layout, "Result cache folder",
+                                                                self.parameters.cache_folder,
+                                                                mode=QFileDialog.Directory)
+        self.spin_cache_ttl = pyqtutils.append_spin(self.grid_layout, "Cache TTL (s, 0: no expiry)",
+                                                    self.parameters.cache_ttl, min=0, max=2147483647)
+        self.spin_cache_size = pyqtutils.append_spin(self.grid_layout, "Cache max size (MB)",
+                                                     self.parameters.cache_max_size_mb, min=0, max=1048576)
+
+        # Localization
+        self.combo_localization = pyqtutils.append_combo(self.grid_layout, "Field localization")
+        for localization in ["none", "boxes", "heatmaps"]:
+            self.combo_localization.addItem(localization)
+        self.combo_localization.setCurrentText(self.parameters.localization)
+
+        # Metrics
+        self.combo_metrics_sink = pyqtutils.append_combo(self.grid_layout, "Metrics sink")
+        for sink in ["none", "logger", "prometheus"]:
+            self.combo_metrics_sink.addItem(sink)
+        self.combo_metrics_sink.setCurrentText(self.parameters.metrics_sink)
+
+        self.browse_metrics_file = pyqtutils.append_browse_file(self.grid_layout, "Prometheus metrics file",
+                                                                self.parameters.metrics_file,
+                                                                mode=QFileDialog.AnyFile)
+
+        self.check_attach_metrics = pyqtutils.append_check(self.grid_layout, "Add metrics to output",
+                                                           self.parameters.attach_metrics)
+
         # PyQt -> Qt wrapping
         layout_ptr = qtconversion.PyQtToQt(self.grid_layout)
 
         # Set widget layout
         self.set_layout(layout_ptr)
 
+    def get_shortlist(self):
+        return self.parameters.vocab_shortlist, self.parameters.shortlist_corpus, self.parameters.shortlist_min_count
+
     def on_apply(self):
         # Apply button clicked slot
         # Get parameters from widget
         self.parameters.prompt = self.edit_prompt.text()
         self.parameters.cuda = self.check_cuda.isChecked()
+        self.parameters.precision = self.combo_precision.currentText()
+        self.parameters.attention_backend = self.combo_attention.currentText()
+        self.parameters.vocab_shortlist = self.check_vocab_shortlist.isChecked()
+        self.parameters.shortlist_corpus = self.browse_shortlist_corpus.path
+        self.parameters.shortlist_min_count = self.spin_shortlist_min_count.value()
+        self.parameters.cascade = self.check_cascade.isChecked()
+        self.parameters.cascade_routes = self.edit_cascade_routes.text()
+        self.parameters.torch_compile = self.check_compile.isChecked()
+        self.parameters.compile_cache_folder = self.browse_compile_cache.path
+        self.parameters.warmup = self.check_warmup.isChecked()
+        self.parameters.state_cache_size = self.spin_state_cache_size.value()
+        self.parameters.trim_padding = self.check_trim_padding.isChecked()
+        self.parameters.localization = self.combo_localization.currentText()
+        self.parameters.pages = self.edit_pages.text()
+        self.parameters.page_batch_size = self.spin_page_batch_size.value()
+        self.parameters.page_confidence_threshold = self.spin_page_threshold.value()
+        self.parameters.stream_mode = self.check_stream_mode.isChecked()
+        self.parameters.stream_threshold = self.spin_stream_threshold.value()
+        self.parameters.stream_max_rate = self.spin_stream_max_rate.value()
+        self.parameters.cache_folder = self.browse_cache_folder.path
+        self.parameters.cache_ttl = self.spin_cache_ttl.value()
+        self.parameters.cache_max_size_mb = self.spin_cache_size.value()
+        self.parameters.metrics_sink = self.combo_metrics_sink.currentText()
+        self.parameters.metrics_file = self.browse_metrics_file.path
+        self.parameters.attach_metrics = self.check_attach_metrics.isChecked()
         model_name_input = self.browse_model_name.path
 
         if model_name_input != '':
@@ -93,10 +216,22 @@ class InferDonutWidget(core.CWorkflowTaskWidget):
             self.parameters.task_name = model_zoo[self.parameters.model_name]
 
         # Check state changes
-        if self.parameters.model_name != self.model_name or self.parameters.cuda != self.cuda:
+        if (self.parameters.model_name != self.model_name or self.parameters.cuda != self.cuda or
+                self.parameters.precision != self.precision or
+                self.parameters.attention_backend != self.attention_backend or
+                self.parameters.torch_compile != self.torch_compile or self.parameters.warmup != self.warmup or
+                self.parameters.cascade != self.cascade or self.get_shortlist() != self.shortlist):
             self.model_name = self.parameters.model_name
             self.cuda = self.parameters.cuda
+            self.precision = self.parameters.precision
+            self.attention_backend = self.parameters.attention_backend
+            self.torch_compile = self.parameters.torch_compile
+            self.warmup = self.parameters.warmup
+            self.cascade = self.parameters.cascade
+            self.shortlist = self.get_shortlist()
             self.parameters.update = True
+            # start loading the new model right away, the process waits for it only if needed
+            self.parameters.preload()
 
         # Send signal to launch the process
         self.emit_apply(self.parameters)
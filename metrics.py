@@ -0,0 +1,232 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# --------------------
+# - Structured metrics collected during one run of the process
+# --------------------
+class RunMetrics:
+
+    def __init__(self, model_name="", task_name="", cuda=False):
+        self.model_name = model_name
+        self.task_name = task_name
+        self.cuda = cuda and torch.cuda.is_available()
+        self.timings = {}
+        self.caches = {}
+        self.counters = {}
+        self.background_timings = {}
+        self.num_tokens = 0
+        self._start = time.perf_counter()
+
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    @contextmanager
+    def stage(self, name):
+        # Accumulate wall time (seconds) spent in the given stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                torch.cuda.synchronize()
+            self.add_timing(name, time.perf_counter() - start)
+
+    def add_timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def add_timings(self, timings, prefix=""):
+        for name, seconds in timings.items():
+            self.add_timing(prefix + name, seconds)
+
+    def add_background_timings(self, name, timings):
+        # Work done outside of the run (e.g. background model load), not part of the run stages
+        self.background_timings[name] = dict(timings)
+
+    def add_tokens(self, count):
+        self.num_tokens += int(count)
+
+    def record_cache(self, name, hit):
+        stats = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+
+    def set_counter(self, name, value):
+        self.counters[name] = value
+
+    def to_dict(self):
+        # decoding time of every model run (stages may be prefixed, e.g. classify_decode in cascade mode)
+        decode_time = sum(seconds for name, seconds in self.timings.items()
+                          if name == "decode" or name.endswith("_decode"))
+        metrics = {
+            "model_name": self.model_name,
+            "task_name": self.task_name,
+            "total_time": time.perf_counter() - self._start,
+            "timings": dict(self.timings),
+            "background_timings": dict(self.background_timings),
+            "generated_tokens": self.num_tokens,
+            "tokens_per_second": self.num_tokens / decode_time if decode_time > 0 else 0.0,
+            "process_peak_rss_mb": process_peak_rss_mb(),
+            "peak_cuda_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if self.cuda else 0.0,
+            "caches": {},
+        }
+        for name, stats in self.caches.items():
+            lookups = stats["hits"] + stats["misses"]
+            metrics["caches"][name] = dict(stats, hit_rate=stats["hits"] / lookups if lookups else 0.0)
+
+        metrics.update(self.counters)
+        return metrics
+
+
+def process_peak_rss_mb():
+    # Peak resident set size over the whole process lifetime, not per run
+    # (ru_maxrss is in KB on Linux, bytes on macOS)
+    if resource is None:
+        return 0.0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+# --------------------
+# - Metrics sinks: each one exposes export(metrics) taking the dict built by RunMetrics.to_dict()
+# --------------------
+class LoggerSink:
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    @staticmethod
+    def format_timings(timings):
+        return ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items())
+
+    def export(self, metrics):
+        message = (f"infer_donut [{metrics['model_name']}] total={metrics['total_time'] * 1000:.1f}ms "
+                   f"({self.format_timings(metrics['timings'])}) tokens={metrics['generated_tokens']} "
+                   f"tokens/s={metrics['tokens_per_second']:.1f} "
+                   f"process_peak_rss={metrics['process_peak_rss_mb']:.0f}MB "
+                   f"peak_cuda={metrics['peak_cuda_mb']:.0f}MB caches={metrics['caches']}")
+        for model_name, timings in metrics.get("background_timings", {}).items():
+            message += f" background [{model_name}] ({self.format_timings(timings)})"
+        self.log.log(self.level, message)
+
+
+class PrometheusFileSink:
+    # Write metrics in Prometheus text exposition format (node_exporter textfile collector)
+    # Counters are accumulated per (model, task) series, every series seen so far is written at each export.
+    # Background timings (model load/compile/warmup) are labelled with the loaded model (cascade: several per series)
+
+    def __init__(self, path, prefix="infer_donut"):
+        self.path = path
+        self.prefix = prefix
+        self.series = {}
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def export(self, metrics):
+        key = (metrics["model_name"], metrics["task_name"])
+        series = self.series.setdefault(key, {"runs": 0, "tokens": 0, "stage_seconds": {}, "caches": {},
+                                              "background_seconds": {}})
+        series["runs"] += 1
+        series["tokens"] += metrics["generated_tokens"]
+        for name, seconds in metrics["timings"].items():
+            series["stage_seconds"][name] = series["stage_seconds"].get(name, 0.0) + seconds
+        for name, stats in metrics["caches"].items():
+            totals = series["caches"].setdefault(name, {"hits": 0, "misses": 0})
+            totals["hits"] += stats["hits"]
+            totals["misses"] += stats["misses"]
+        for model_name, timings in metrics.get("background_timings", {}).items():
+            for name, seconds in timings.items():
+                background = series["background_seconds"]
+                background[(model_name, name)] = background.get((model_name, name), 0.0) + seconds
+        series["last"] = metrics
+
+        p = self.prefix
+        sections = {name: [] for name in ("runs_total", "generated_tokens_total", "stage_seconds_total",
+                                          "background_stage_seconds_total", "cache_hits_total",
+                                          "cache_misses_total", "last_stage_seconds", "last_total_seconds",
+                                          "last_tokens_per_second", "process_peak_rss_bytes", "peak_cuda_bytes")}
+        for (model_name, task_name), series in self.series.items():
+            labels = f'model="{self.escape(model_name)}",task="{self.escape(task_name)}"'
+            last = series["last"]
+            sections["runs_total"].append(f"{p}_runs_total{{{labels}}} {series['runs']}")
+            sections["generated_tokens_total"].append(f"{p}_generated_tokens_total{{{labels}}} {series['tokens']}")
+            for name, seconds in series["stage_seconds"].items():
+                sections["stage_seconds_total"].append(
+                    f'{p}_stage_seconds_total{{{labels},stage="{self.escape(name)}"}} {seconds:.6f}')
+            for (model, name), seconds in series["background_seconds"].items():
+                sections["background_stage_seconds_total"].append(
+                    f'{p}_background_stage_seconds_total{{{labels},loaded_model="{self.escape(model)}",'
+                    f'stage="{self.escape(name)}"}} {seconds:.6f}')
+            for name, stats in series["caches"].items():
+                for outcome in ("hits", "misses"):
+                    sections[f"cache_{outcome}_total"].append(
+                        f'{p}_cache_{outcome}_total{{{labels},cache="{self.escape(name)}"}} {stats[outcome]}')
+            for name, seconds in last["timings"].items():
+                sections["last_stage_seconds"].append(
+                    f'{p}_last_stage_seconds{{{labels},stage="{self.escape(name)}"}} {seconds:.6f}')
+
+            gauges = {
+                "last_total_seconds": last["total_time"],
+                "last_tokens_per_second": last["tokens_per_second"],
+                "process_peak_rss_bytes": last["process_peak_rss_mb"] * 2 ** 20,
+                "peak_cuda_bytes": last["peak_cuda_mb"] * 2 ** 20,
+            }
+            for name, value in gauges.items():
+                sections[name].append(f"{p}_{name}{{{labels}}} {value:.6f}")
+
+        lines = []
+        for name, samples in sections.items():
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {p}_{name} {metric_type}")
+            lines.extend(samples)
+
+        # Atomic replace so that scrapers never read a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+class CallbackSink:
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, metrics):
+        self.callback(metrics)
@@ -3,10 +3,18 @@ Donut
 Copyright (c) 2022-present NAVER Corp.
 MIT License
 """
+import hashlib
+import io
+import json
 import math
 import os
 import re
-from typing import Any, List, Optional, Union
+import threading
+import time
+import types
+import warnings
+from collections import Counter, OrderedDict
+from typing import Any, BinaryIO, List, Optional, Tuple, Union
 
 import numpy as np
 import PIL
@@ -16,14 +24,77 @@ import torch.nn as nn
 import torch.nn.functional as F
 from PIL import ImageOps
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
-from timm.models.swin_transformer import SwinTransformer
+from timm.models.swin_transformer import SwinTransformer, WindowAttention
 from torchvision import transforms
 from torchvision.transforms.functional import resize, rotate
 from transformers import MBartConfig, MBartForCausalLM, XLMRobertaTokenizer
 from transformers.file_utils import ModelOutput
+from transformers.models.mbart.modeling_mbart import MBartAttention
 from transformers.modeling_utils import PretrainedConfig, PreTrainedModel
 
 
+def canvas_scale(size: Tuple[int, int], input_size: List[int], align_long_axis: bool) -> float:
+    """
+    Scale factor applied by SwinEncoder.prepare_input to an image of the given (width, height)
+    """
+    width, height = size
+    if align_long_axis and (
+        (input_size[0] > input_size[1] and width > height) or (input_size[0] < input_size[1] and width < height)
+    ):
+        width, height = height, width
+    scale = min(input_size) / min(width, height)
+    # thumbnail only shrinks the resized image to fit the canvas
+    return scale * min(1.0, input_size[1] / (width * scale), input_size[0] / (height * scale))
+
+
+def sequence_confidences(
+    sequences: torch.Tensor, scores: Tuple[torch.Tensor], prompt_length: int, eos_token_id: int
+) -> torch.Tensor:
+    """
+    Product of the probabilities of the generated tokens of each sequence.
+    The last token of each sequence (eos) is left out, as well as the padding of sequences of a batch
+    that finished before the others
+
+    Args:
+        sequences: (batch_size, prompt_length + num_steps) token ids returned by generate
+        scores: num_steps logits of shape (batch_size, vocab_size) returned by generate
+    """
+    gen_sequences = sequences[:, prompt_length:]
+    probs = torch.stack(scores, dim=1).float().softmax(-1)
+    gen_probs = torch.gather(probs, 2, gen_sequences[:, :, None]).squeeze(-1)
+    is_eos = gen_sequences.eq(eos_token_id)
+    gen_lengths = is_eos.int().argmax(-1) + 1
+    gen_lengths[~is_eos.any(-1)] = gen_sequences.shape[-1]
+    positions = torch.arange(gen_sequences.shape[-1], device=gen_sequences.device)
+    gen_probs = gen_probs.masked_fill(positions[None, :] >= gen_lengths[:, None] - 1, 1.0)
+    return gen_probs.prod(-1)
+
+
+def load_image(
+    source: Union[str, bytes, os.PathLike, BinaryIO], input_size: List[int], align_long_axis: bool = False
+) -> PIL.Image.Image:
+    """
+    Open an encoded image and decode it at the lowest resolution still larger than what the canvas needs,
+    JPEG files are downscaled by the decoder itself (DCT scaling, PIL draft mode) so that large photos are
+    never decoded at full resolution. Other formats are decoded normally
+
+    Args:
+        source: file path, encoded bytes or binary file object
+        input_size: canvas size (height, width) of the encoder
+        align_long_axis: whether the encoder rotates images to align their long axis with the canvas
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    img = PIL.Image.open(source)
+
+    # EXIF orientation is applied after decoding and may swap width and height: keep the larger requirement
+    scale = max(canvas_scale(img.size, input_size, align_long_axis),
+                canvas_scale(img.size[::-1], input_size, align_long_axis))
+    if scale < 1.0:
+        img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    return ImageOps.exif_transpose(img)
+
+
 class SwinEncoder(nn.Module):
     r"""
     Donut encoder based on SwinTransformer
@@ -101,19 +172,38 @@ class SwinEncoder(nn.Module):
         x = self.model.layers(x)
         return x
 
-    def prepare_input(self, img: PIL.Image.Image, random_padding: bool = False) -> torch.Tensor:
+    def load_image(self, source: Union[str, bytes, os.PathLike, BinaryIO]) -> PIL.Image.Image:
+        """
+        Decode an encoded image (file path or bytes) directly near the canvas size, see load_image
+        """
+        return load_image(source, self.input_size, self.align_long_axis)
+
+    def prepare_input(
+        self, img: PIL.Image.Image, random_padding: bool = False, return_content_region: bool = False
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, dict]]:
         """
         Convert PIL Image to tensor according to specified input_size after following steps below:
             - resize
             - rotate (if align_long_axis is True and image is not aligned longer axis with canvas)
             - pad
+
+        Args:
+            return_content_region: also return where the image content lies in the canvas, as a dict with
+                box: (left, top, right, bottom) in canvas pixels
+                scale: (x, y) resize factors from the (rotated) input image to the canvas
+                rotated: whether the image was rotated to align its long axis
+                image_size: (width, height) of the input image
         """
         img = img.convert("RGB")
+        image_size = img.size
+        rotated = False
         if self.align_long_axis and (
             (self.input_size[0] > self.input_size[1] and img.width > img.height)
             or (self.input_size[0] < self.input_size[1] and img.width < img.height)
         ):
             img = rotate(img, angle=-90, expand=True)
+            rotated = True
+        aligned_size = img.size
         img = resize(img, min(self.input_size))
         img.thumbnail((self.input_size[1], self.input_size[0]))
         delta_width = self.input_size[1] - img.width
@@ -130,7 +220,57 @@ class SwinEncoder(nn.Module):
             delta_width - pad_width,
             delta_height - pad_height,
         )
-        return self.to_tensor(ImageOps.expand(img, padding))
+        image_tensor = self.to_tensor(ImageOps.expand(img, padding))
+        if not return_content_region:
+            return image_tensor
+
+        content_region = {
+            "box": (pad_width, pad_height, pad_width + img.width, pad_height + img.height),
+            "scale": (img.width / aligned_size[0], img.height / aligned_size[1]),
+            "rotated": rotated,
+            "image_size": image_size,
+        }
+        return image_tensor, content_region
+
+    @property
+    def output_grid(self) -> Tuple[int, int]:
+        """
+        (rows, columns) of the patch grid covered by the encoder output sequence
+        """
+        return tuple(self.model.layers[-1].input_resolution)
+
+    def content_token_indices(self, content_region: dict) -> torch.Tensor:
+        """
+        Positions (row-major) of the encoder output tokens whose patch overlaps the image content,
+        tokens lying entirely in the padding added by prepare_input are left out
+        """
+        rows, cols = self.output_grid
+        cell_height = self.input_size[0] / rows
+        cell_width = self.input_size[1] / cols
+        left, top, right, bottom = content_region["box"]
+        row_ids = torch.arange(rows)
+        col_ids = torch.arange(cols)
+        keep_rows = row_ids[(row_ids * cell_height < bottom) & ((row_ids + 1) * cell_height > top)]
+        keep_cols = col_ids[(col_ids * cell_width < right) & ((col_ids + 1) * cell_width > left)]
+        return (keep_rows[:, None] * cols + keep_cols[None, :]).flatten()
+
+    @staticmethod
+    def canvas_to_image_box(box: Tuple[float, float, float, float], content_region: dict) -> List[float]:
+        """
+        Map a (left, top, right, bottom) box from canvas pixels back to input image pixels
+        """
+        left, top, right, bottom = box
+        content_left, content_top, content_right, content_bottom = content_region["box"]
+        scale_x, scale_y = content_region["scale"]
+        left = (min(max(left, content_left), content_right) - content_left) / scale_x
+        right = (min(max(right, content_left), content_right) - content_left) / scale_x
+        top = (min(max(top, content_top), content_bottom) - content_top) / scale_y
+        bottom = (min(max(bottom, content_top), content_bottom) - content_top) / scale_y
+        if content_region["rotated"]:
+            # undo the clockwise rotation: (x, y) in the rotated image is (height - y, x) in the input image
+            height = content_region["image_size"][1]
+            left, top, right, bottom = top, height - right, bottom, height - left
+        return [left, top, right, bottom]
 
 
 class BARTDecoder(nn.Module):
@@ -173,6 +313,8 @@ class BARTDecoder(nn.Module):
             )
         )
         self.model.forward = self.forward  #  to get cross attentions and utilize `generate` function
+        self.cross_attention_reducer = None  # optional CrossAttentionHeatmap fed at each decoding step
+        self.vocab_shortlist = None  # optional VocabShortlist replacing the full lm_head projection at inference
 
         self.model.config.is_encoder_decoder = True  # to get cross-attention
         self.add_special_tokens(["<sep/>"])  # <sep/> is used for representing a list in a JSON
@@ -210,6 +352,8 @@ class BARTDecoder(nn.Module):
         """
         Args:
             input_ids: (batch_size, sequence_lenth)
+            past_key_values: states of input_ids[:, :-1], also at the first step when generate is seeded
+                with cached prompt states (see prefill)
         Returns:
             input_ids: (batch_size, sequence_length)
             attention_mask: (batch_size, sequence_length)
@@ -227,6 +371,56 @@ class BARTDecoder(nn.Module):
         }
         return output
 
+    def cross_key_values(self, encoder_hidden_states: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Cross-attention keys and values of every decoder layer, as stored in the KV cache
+
+        Args:
+            encoder_hidden_states: (batch_size, sequence_length, hidden_size)
+        Returns:
+            per layer (key, value), each (batch_size, num_heads, sequence_length, head_dim)
+        """
+        batch_size = encoder_hidden_states.shape[0]
+        key_values = []
+        for layer in self.model.model.decoder.layers:
+            attn = layer.encoder_attn
+            key_values.append((
+                attn._shape(attn.k_proj(encoder_hidden_states), -1, batch_size),
+                attn._shape(attn.v_proj(encoder_hidden_states), -1, batch_size),
+            ))
+        return key_values
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        past_key_values: Tuple[Tuple[torch.Tensor]],
+    ) -> Tuple[Tuple[torch.Tensor]]:
+        """
+        Extend a KV cache with prompt tokens, without computing logits
+
+        Args:
+            input_ids: (batch_size, sequence_length) tokens following the ones already in past_key_values
+            encoder_hidden_states: (batch_size, sequence_length, hidden_size)
+            past_key_values: per layer (self key, self value, cross key, cross value),
+                self-attention states may be empty (sequence length 0)
+        Returns:
+            extended past_key_values
+        """
+        if input_ids.shape[1] == 0:
+            return past_key_values
+        past_length = past_key_values[0][0].shape[2]
+        attention_mask = input_ids.new_ones((input_ids.shape[0], past_length + input_ids.shape[1]))
+        outputs = self.model.model.decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outputs.past_key_values
+
     def forward(
         self,
         input_ids,
@@ -262,18 +456,24 @@ class BARTDecoder(nn.Module):
             output_hidden_states if output_hidden_states is not None else self.model.config.output_hidden_states
         )
         return_dict = return_dict if return_dict is not None else self.model.config.use_return_dict
+        reducer = self.cross_attention_reducer
         outputs = self.model.model.decoder(
             input_ids=input_ids,
             attention_mask=attention_mask,
             encoder_hidden_states=encoder_hidden_states,
             past_key_values=past_key_values,
             use_cache=use_cache,
-            output_attentions=output_attentions,
+            output_attentions=output_attentions or reducer is not None,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
         )
+        if reducer is not None:
+            reducer.update(input_ids, outputs.cross_attentions if return_dict else outputs[-1])
 
-        logits = self.model.lm_head(outputs[0])
+        if self.vocab_shortlist is not None and labels is None:
+            logits = self.vocab_shortlist(outputs[0], self.model.lm_head)
+        else:
+            logits = self.model.lm_head(outputs[0])
 
         loss = None
         if labels is not None:
@@ -316,6 +516,379 @@ class BARTDecoder(nn.Module):
         return weight
 
 
+class VocabShortlist(nn.Module):
+    """
+    Projection of the decoder hidden states onto a task-specific subset of the vocabulary.
+    The lm_head rows of the allowed tokens are sliced once, logits of the other tokens are set to -inf,
+    so token ids and token2json are unchanged. The shortlisted argmax is kept only when no excluded token can
+    beat it: by Cauchy-Schwarz, an excluded logit is at most |h| * max excluded row norm + max excluded bias.
+    Otherwise the step falls back to the full projection, so greedy decoding picks the same tokens.
+    The softmax excludes the mass of the other tokens, so confidences are inflated
+
+    Args:
+        lm_head: full vocabulary projection of the decoder
+        token_ids: allowed token ids
+    """
+
+    def __init__(self, lm_head: nn.Linear, token_ids: List[int]):
+        super().__init__()
+        self.vocab_size = lm_head.weight.shape[0]
+        # non persistent: the shortlist is built at load time and never saved with the checkpoint
+        token_ids = torch.tensor(sorted(set(token_ids)), device=lm_head.weight.device)
+        bias = None if lm_head.bias is None else lm_head.bias.detach()[token_ids].clone()
+        self.register_buffer("token_ids", token_ids, persistent=False)
+        self.register_buffer("weight", lm_head.weight.detach()[token_ids].clone(), persistent=False)
+        self.register_buffer("bias", bias, persistent=False)
+
+        # upper bound of the excluded logits, computed once in float32
+        excluded = torch.ones(self.vocab_size, dtype=torch.bool, device=token_ids.device)
+        excluded[token_ids] = False
+        excluded_weight = lm_head.weight.detach()[excluded].float()
+        self.excluded_norm = float(excluded_weight.norm(dim=-1).max()) if len(excluded_weight) else 0.0
+        if not len(excluded_weight):
+            self.excluded_bias = float("-inf")
+        elif lm_head.bias is None:
+            self.excluded_bias = 0.0
+        else:
+            self.excluded_bias = float(lm_head.bias.detach()[excluded].float().max())
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.steps = 0
+        self.fallbacks = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.token_ids),
+            "steps": self.steps,
+            "fallbacks": self.fallbacks,
+            "fallback_rate": self.fallbacks / self.steps if self.steps else 0.0,
+        }
+
+    def forward(self, hidden_states: torch.Tensor, lm_head: nn.Linear) -> torch.Tensor:
+        """
+        Args:
+            hidden_states: (batch_size, sequence_length, hidden_size)
+        Returns:
+            logits: (batch_size, sequence_length, vocab_size)
+        """
+        shortlist_logits = F.linear(hidden_states, self.weight, self.bias)
+        self.steps += 1
+        # only the last position is used by generate
+        bound = hidden_states[:, -1].float().norm(dim=-1) * self.excluded_norm + self.excluded_bias
+        # margin for the rounding of the projection in reduced precision
+        bound = bound + bound.abs() * 16 * torch.finfo(hidden_states.dtype).eps
+        best_logit = shortlist_logits[:, -1].float().max(-1).values
+        if bool((best_logit <= bound).any()):
+            self.fallbacks += 1
+            return lm_head(hidden_states)
+
+        logits = shortlist_logits.new_full((*shortlist_logits.shape[:-1], self.vocab_size), float("-inf"))
+        logits[..., self.token_ids] = shortlist_logits
+        return logits
+
+
+class CrossAttentionHeatmap:
+    """
+    Online reduction of the decoder cross-attentions into one heatmap per generated JSON field,
+    so that localization does not require keeping the attentions of every step and layer
+
+    At each decoding step, the cross-attention of the last query position is averaged over layers and heads.
+    It is attributed to the token generated at that step (known at the next step), then accumulated
+    into the innermost open `<s_key>` field. Field names follow the keys of token2json: the task start token
+    is not a field, and the tokens of a parent field around its nested fields are merged into one entry.
+    Each list item (`<sep/>`) gets its own entry. Only one running sum per field entry is kept.
+
+    Args:
+        tokenizer: tokenizer of the decoder
+        grid: (rows, columns) of the encoder output patch grid
+        token_indices: positions in the patch grid of the encoder tokens fed to the decoder, all if None
+    """
+
+    def __init__(self, tokenizer: XLMRobertaTokenizer, grid: Tuple[int, int], token_indices: torch.Tensor = None):
+        self.tokenizer = tokenizer
+        self.grid = grid
+        self.token_indices = token_indices
+        # categorical values (e.g. <letter/>) are additional special tokens but belong to their field
+        self.ignored_ids = {
+            token_id
+            for token_id in (tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id,
+                             tokenizer.unk_token_id, tokenizer.cls_token_id, tokenizer.sep_token_id,
+                             tokenizer.mask_token_id)
+            if token_id is not None
+        }
+        self.pending = None
+        self.states = None
+
+    def _new_state(self):
+        # open: stack of (key, index of its entry in fields)
+        return {"started": False, "open": [], "fields": []}
+
+    def _new_field(self, state, name: str) -> int:
+        state["fields"].append({"field": name, "sum": None, "count": 0})
+        return len(state["fields"]) - 1
+
+    def _consume(self, state, token_id: int, attention: Optional[torch.Tensor]):
+        if not state["started"]:
+            # task start token (e.g. <s_docvqa>), removed by token2json
+            state["started"] = True
+            return
+
+        token = self.tokenizer.convert_ids_to_tokens(token_id)
+        start_key = re.fullmatch(r"<s_(.+)>", token)
+        end_key = re.fullmatch(r"</s_(.+)>", token)
+        if start_key:
+            name = ".".join([key for key, _ in state["open"]] + [start_key.group(1)])
+            state["open"].append((start_key.group(1), self._new_field(state, name)))
+        elif end_key:
+            if state["open"] and state["open"][-1][0] == end_key.group(1):
+                state["open"].pop()
+        elif token == "<sep/>":
+            if state["open"]:
+                key, index = state["open"][-1]
+                state["open"][-1] = (key, self._new_field(state, state["fields"][index]["field"]))
+        elif token_id not in self.ignored_ids and attention is not None:
+            if not state["open"]:
+                # text outside any field, token2json returns it as text_sequence
+                state["open"].append(("", self._new_field(state, "text_sequence")))
+            field = state["fields"][state["open"][-1][1]]
+            field["sum"] = attention if field["sum"] is None else field["sum"] + attention
+            field["count"] += 1
+
+    def update(self, input_ids: torch.Tensor, cross_attentions: Tuple[torch.Tensor]):
+        """
+        Args:
+            input_ids: (batch_size, sequence_length) decoder inputs of the current step
+            cross_attentions: per layer (batch_size, num_heads, sequence_length, encoder_sequence_length)
+        """
+        attention = torch.stack([layer[:, :, -1, :] for layer in cross_attentions]).float().mean(dim=(0, 2))
+        if self.states is None:
+            # prefill: the prompt only opens fields (e.g. <s_question>), it has no attention to attribute
+            self.states = [self._new_state() for _ in range(input_ids.shape[0])]
+            for state, ids in zip(self.states, input_ids.tolist()):
+                for token_id in ids:
+                    self._consume(state, token_id, None)
+        else:
+            for i, state in enumerate(self.states):
+                self._consume(state, int(input_ids[i, -1]), self.pending[i])
+        self.pending = attention
+
+    def finalize(self, last_token_ids: torch.Tensor = None) -> List[List[dict]]:
+        """
+        Args:
+            last_token_ids: (batch_size,) tokens generated at the last step, never fed back to the decoder,
+                whose attention is still pending (e.g. a value cut by max_length)
+        Returns:
+            per batch element, a list of {"field": dotted JSON key, "heatmap": (rows, columns) float tensor}
+        """
+        if self.pending is not None and last_token_ids is not None:
+            for i, state in enumerate(self.states):
+                self._consume(state, int(last_token_ids[i]), self.pending[i])
+            self.pending = None
+
+        results = []
+        for state in self.states or []:
+            fields = []
+            for field in state["fields"]:
+                if field["count"] == 0:
+                    continue
+                heatmap = field["sum"] / field["count"]
+                if self.token_indices is not None:
+                    full = heatmap.new_zeros(self.grid[0] * self.grid[1])
+                    full[self.token_indices] = heatmap
+                    heatmap = full
+                fields.append({"field": field["field"], "heatmap": heatmap.reshape(self.grid).cpu()})
+            results.append(fields)
+        return results
+
+    @staticmethod
+    def heatmap_to_box(heatmap: torch.Tensor, canvas_size: Tuple[int, int], threshold: float = 0.5):
+        """
+        Bounding box (left, top, right, bottom) in canvas pixels of the cells above threshold * max
+        """
+        rows, cols = torch.nonzero(heatmap >= threshold * heatmap.max(), as_tuple=True)
+        cell_height = canvas_size[0] / heatmap.shape[0]
+        cell_width = canvas_size[1] / heatmap.shape[1]
+        return (
+            float(cols.min()) * cell_width,
+            float(rows.min()) * cell_height,
+            float(cols.max() + 1) * cell_width,
+            float(rows.max() + 1) * cell_height,
+        )
+
+
+class DecoderStateCache:
+    """
+    LRU cache of the decoder states computed for an image, reused by later inference calls on the same image
+    (e.g. several DocVQA questions, or a repeated request):
+        - encoder output (after padding trimming) and cross-attention keys/values of every decoder layer
+        - self-attention keys/values of prompt prefixes (the prompt without its last token)
+
+    Self-attention states of prompt tokens depend on the image through the cross-attentions of the previous
+    layers, so prompt prefixes are only reused for the same image. A new prompt extends the longest cached
+    prefix, and the leading special tokens of each prompt (e.g. <s_docvqa><s_question>) are kept as their own
+    entry so that different questions share them.
+
+    Args:
+        max_images: number of images whose states are kept (encoder output and cross-attention keys/values
+            take about 180MB per image for the default 2560x1920 canvas in float32)
+        max_prefixes: number of prompt prefixes kept per image
+    """
+
+    def __init__(self, max_images: int = 2, max_prefixes: int = 8):
+        self.max_images = max_images
+        self.max_prefixes = max_prefixes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_tensors: torch.Tensor, *identity) -> str:
+        """
+        Key of an image from its input tensor and anything else changing the encoder output (e.g. trimming)
+        """
+        h = hashlib.blake2b(digest_size=32)
+        h.update(repr((tuple(image_tensors.shape), str(image_tensors.dtype)) + identity).encode())
+        h.update(image_tensors.detach().cpu().float().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def resize(self, max_images: int):
+        # keeps the most recent entries
+        with self.lock:
+            self.max_images = max_images
+            while len(self.entries) > self.max_images:
+                self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, last_hidden_state: torch.Tensor, cross_key_values: List[Tuple[torch.Tensor]]) -> dict:
+        entry = {"last_hidden_state": last_hidden_state, "cross_key_values": cross_key_values,
+                 "prefixes": OrderedDict()}
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_images:
+                self.entries.popitem(last=False)
+        return entry
+
+    def get_prefix(self, entry: dict, prefix: Tuple[Tuple[int]]) -> Tuple[int, Optional[Tuple[Tuple[torch.Tensor]]]]:
+        """
+        Longest cached prefix of the given token rows (same batch size), returns (length, past_key_values or None)
+        """
+        best_length, best = 0, None
+        with self.lock:
+            for cached, past_key_values in entry["prefixes"].items():
+                length = len(cached[0])
+                if len(cached) == len(prefix) and best_length < length <= len(prefix[0]) and all(
+                    row[:length] == cached_row for row, cached_row in zip(prefix, cached)
+                ):
+                    best_length, best = length, cached
+            if best is None:
+                return 0, None
+            entry["prefixes"].move_to_end(best)
+            return best_length, entry["prefixes"][best]
+
+    def put_prefix(self, entry: dict, prefix: Tuple[Tuple[int]], past_key_values: Tuple[Tuple[torch.Tensor]]):
+        with self.lock:
+            entry["prefixes"][prefix] = past_key_values
+            entry["prefixes"].move_to_end(prefix)
+            while len(entry["prefixes"]) > self.max_prefixes:
+                entry["prefixes"].popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def sdpa_window_attention_forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    timm WindowAttention.forward computed with scaled_dot_product_attention,
+    the relative position bias and the shifted-window mask are passed as an additive attention mask
+
+    Args:
+        x: (num_windows * batch_size, window_area, dim)
+        mask: (num_windows, window_area, window_area) or None
+    """
+    B_, N, C = x.shape
+    head_dim = C // self.num_heads
+    qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.unbind(0)
+    q = q * (self.scale * math.sqrt(head_dim))  # sdpa applies 1 / sqrt(head_dim), keep the module scale
+
+    attn_mask = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(N, N, -1)
+    attn_mask = attn_mask.permute(2, 0, 1).to(q.dtype)
+    if mask is not None:
+        # split windows from batch so that the (nW, heads, N, N) mask broadcasts without a copy
+        nW = mask.shape[0]
+        q, k, v = (t.view(B_ // nW, nW, self.num_heads, N, head_dim) for t in (q, k, v))
+        attn_mask = attn_mask.unsqueeze(0) + mask.unsqueeze(1).to(q.dtype)
+
+    dropout_p = self.attn_drop.p if self.training else 0.0
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    x = x.reshape(B_, self.num_heads, N, head_dim).transpose(1, 2).reshape(B_, N, C)
+    x = self.proj(x)
+    x = self.proj_drop(x)
+    return x
+
+
+def sdpa_mbart_attention_forward(
+    self,
+    hidden_states: torch.Tensor,
+    key_value_states: Optional[torch.Tensor] = None,
+    past_key_value: Optional[Tuple[torch.Tensor]] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+    layer_head_mask: Optional[torch.Tensor] = None,
+    output_attentions: bool = False,
+):
+    """
+    MBartAttention.forward computed with scaled_dot_product_attention, same KV cache layout.
+    Attention weights are never materialized: the eager implementation is used when they are requested
+    (output_attentions, e.g. for heatmaps) or when a head mask is given
+    """
+    if output_attentions or layer_head_mask is not None:
+        return type(self).forward(
+            self, hidden_states, key_value_states, past_key_value, attention_mask, layer_head_mask, output_attentions
+        )
+
+    is_cross_attention = key_value_states is not None
+    bsz, tgt_len, _ = hidden_states.size()
+    query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+
+    if is_cross_attention and past_key_value is not None and past_key_value[0].shape[2] == key_value_states.shape[1]:
+        # reuse cross-attention keys and values
+        key_states = past_key_value[0]
+        value_states = past_key_value[1]
+    elif is_cross_attention:
+        key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
+        value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
+    elif past_key_value is not None:
+        key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+        value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+        key_states = torch.cat([past_key_value[0], key_states], dim=2)
+        value_states = torch.cat([past_key_value[1], value_states], dim=2)
+    else:
+        key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+        value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+
+    if self.is_decoder:
+        past_key_value = (key_states, value_states)
+
+    # default sdpa scale 1 / sqrt(head_dim) is MBartAttention.scaling
+    attn_output = F.scaled_dot_product_attention(
+        query_states,
+        key_states,
+        value_states,
+        attn_mask=attention_mask,
+        dropout_p=self.dropout if self.training else 0.0,
+    )
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+    attn_output = self.out_proj(attn_output)
+    return attn_output, None, past_key_value
+
+
 class DonutConfig(PretrainedConfig):
     r"""
     This is the configuration class to store the configuration of a [`DonutModel`]. It is used to
@@ -391,6 +964,165 @@ class DonutModel(PreTrainedModel):
             decoder_layer=self.config.decoder_layer,
             name_or_path=self.config.name_or_path,
         )
+        self.state_cache = None  # optional DecoderStateCache reused by inference calls on the same image
+
+    def set_precision(self, precision: str, device: Union[str, torch.device] = "cpu"):
+        """
+        Cast the encoder and decoder weights for inference and move them to the given device,
+        activations and decoder KV caches follow the weight dtype
+
+        Args:
+            precision: one of
+                - fp32: float32
+                - bf16: bfloat16, native matmul on recent CPUs (AMX/AVX512-BF16) and Ampere+ GPUs
+                - fp16: float16, cuda only (half is not compatible in cpu implementation, float32 is used instead)
+            device: target device
+        """
+        device = torch.device(device)
+        if precision == "bf16":
+            self.to(torch.bfloat16)
+        elif precision == "fp16" and device.type == "cuda":
+            self.half()
+        elif precision in ("fp32", "fp16"):
+            self.float()
+        else:
+            raise ValueError(f"Unknown precision: {precision}")
+        return self.to(device)
+
+    def set_attention_backend(self, backend: str) -> str:
+        """
+        Select the attention implementation of the Swin window attentions and MBart decoder attentions.
+        Forward methods are replaced per module instance, weights and checkpoints are unchanged
+
+        Args:
+            backend: one of
+                - eager: original implementations
+                - sdpa: torch.nn.functional.scaled_dot_product_attention (fused flash / memory-efficient kernels),
+                  PyTorch >= 2.0 only, eager is kept otherwise
+        Returns:
+            backend in use
+        """
+        if backend not in ("eager", "sdpa"):
+            raise ValueError(f"Unknown attention backend: {backend}")
+        if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            warnings.warn("scaled_dot_product_attention requires PyTorch >= 2.0, eager attention is used")
+            backend = "eager"
+
+        for module in self.modules():
+            if isinstance(module, WindowAttention):
+                sdpa_forward = sdpa_window_attention_forward
+            elif isinstance(module, MBartAttention):
+                sdpa_forward = sdpa_mbart_attention_forward
+            else:
+                continue
+
+            if backend == "sdpa":
+                module.forward = types.MethodType(sdpa_forward, module)
+            elif "forward" in module.__dict__:
+                del module.forward
+        return backend
+
+    def build_vocab_shortlist(self, corpus: List[str] = None, min_count: int = 1) -> VocabShortlist:
+        """
+        Restrict the decoder output projection to the tokens the task can emit:
+        special and added tokens (task and JSON keys <s_key>, <sep/>, categorical values), plus the tokens
+        appearing at least min_count times in a calibration corpus of expected outputs
+
+        Args:
+            corpus: expected outputs, one per item, as JSON (ground truth parses) or plain text.
+                Without corpus only special and added tokens are kept, which only suits classification
+            min_count: frequency cut applied to the corpus tokens
+        """
+        if not corpus:
+            warnings.warn("Vocabulary shortlist without corpus: only special and added tokens are kept, "
+                          "text fields fall back to the full vocabulary at every step")
+        tokenizer = self.decoder.tokenizer
+        token_ids = set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+
+        counts = Counter()
+        for item in corpus or []:
+            try:
+                item = json.loads(item)
+            except (TypeError, ValueError):
+                pass
+            if isinstance(item, dict):
+                text = self.json2token(item, update_special_tokens_for_json_key=False)
+            else:
+                text = str(item)
+            counts.update(tokenizer(text, add_special_tokens=False)["input_ids"])
+        token_ids |= {token_id for token_id, count in counts.items() if count >= min_count}
+        token_ids.discard(tokenizer.unk_token_id)  # never generated (bad_words_ids)
+
+        self.decoder.vocab_shortlist = VocabShortlist(self.decoder.model.lm_head, list(token_ids))
+        return self.decoder.vocab_shortlist
+
+    def enable_state_cache(self, max_images: int = 2, max_prefixes: int = 8) -> Optional[DecoderStateCache]:
+        """
+        Reuse the encoder output, cross-attention keys/values and prompt prefix states of recently seen images,
+        see DecoderStateCache (disabled if max_images is 0). An existing cache is resized, its entries are kept
+        """
+        if max_images <= 0:
+            self.state_cache = None
+        elif self.state_cache is None:
+            self.state_cache = DecoderStateCache(max_images, max_prefixes)
+        else:
+            self.state_cache.max_prefixes = max_prefixes
+            self.state_cache.resize(max_images)
+        return self.state_cache
+
+    def compile_for_inference(self, cache_dir: Union[str, os.PathLike] = None, mode: str = None) -> bool:
+        """
+        Compile the Swin encoder (static shape, the canvas size is fixed) and the MBart decoder step
+        (dynamic shapes, sequence and KV cache lengths grow while decoding) with torch.compile.
+        Compilation happens at the first call, see warmup
+
+        Args:
+            cache_dir: folder where compiled artifacts are stored and reused by later processes.
+                TorchInductor reads it once per process: the first folder set (or TORCHINDUCTOR_CACHE_DIR)
+                is shared by every model compiled in the process, artifacts are keyed by graph and device
+            mode: torch.compile mode, e.g. "reduce-overhead" or "max-autotune"
+        Returns:
+            whether the model was compiled (PyTorch >= 2.0, the model is left eager otherwise)
+        """
+        if not hasattr(torch, "compile"):
+            warnings.warn("torch.compile requires PyTorch >= 2.0, the model is not compiled")
+            return False
+
+        if cache_dir:
+            current = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+            if current is None:
+                os.makedirs(cache_dir, exist_ok=True)
+                os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+            elif os.path.abspath(current) != os.path.abspath(cache_dir):
+                warnings.warn(f"TorchInductor cache folder is already set to {current} for this process, "
+                              f"{cache_dir} is not used")
+            try:
+                import torch._inductor.config as inductor_config
+                inductor_config.fx_graph_cache = True
+            except (ImportError, AttributeError):  # FX graph cache is only available from PyTorch 2.1
+                pass
+
+        self.encoder.forward = torch.compile(self.encoder.forward, dynamic=False, mode=mode)
+        decoder = self.decoder.model.model.decoder
+        decoder.forward = torch.compile(decoder.forward, dynamic=True, mode=mode)
+        return True
+
+    def warmup(self, prompt: str, max_new_tokens: int = 8) -> float:
+        """
+        Run a synthetic inference on a blank canvas so that lazy initialization, kernel selection,
+        allocator growth and compilation do not fall on the first real request
+
+        Returns:
+            warmup time in seconds
+        """
+        image = PIL.Image.new("RGB", (self.config.input_size[1], self.config.input_size[0]), "white")
+        prompt_length = len(self.decoder.tokenizer(prompt, add_special_tokens=False)["input_ids"])
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.inference(image=image, prompt=prompt, max_length=prompt_length + max_new_tokens)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
 
     def forward(self, image_tensors: torch.Tensor, decoder_input_ids: torch.Tensor, decoder_labels: torch.Tensor):
         """
@@ -412,24 +1144,45 @@ class DonutModel(PreTrainedModel):
 
     def inference(
         self,
-        image: PIL.Image = None,
+        image: Union[PIL.Image.Image, str, bytes, os.PathLike] = None,
         prompt: str = None,
         image_tensors: Optional[torch.Tensor] = None,
         prompt_tensors: Optional[torch.Tensor] = None,
         return_json: bool = True,
         return_attentions: bool = False,
+        return_timings: bool = False,
+        return_heatmaps: bool = False,
+        trim_padding: bool = False,
+        max_length: int = None,
+        content_region: Union[dict, List[dict]] = None,
+        use_state_cache: bool = True,
     ):
         """
         Generate a token sequence in an auto-regressive manner,
         the generated token sequence is convereted into an ordered JSON format
 
         Args:
-            image: input document image (PIL.Image)
+            image: input document image (PIL.Image), or encoded image (file path or bytes) decoded near the canvas size
             prompt: task prompt (string) to guide Donut Decoder generation
-            image_tensors: (1, num_channels, height, width)
+            image_tensors: (batch_size, num_channels, height, width)
                 convert prompt to tensor if image_tensor is not fed
-            prompt_tensors: (1, sequence_length)
-                convert image to tensor if prompt_tensor is not fed
+            prompt_tensors: (1 or batch_size, sequence_length)
+                convert image to tensor if prompt_tensor is not fed, a single prompt is shared by the batch
+            return_timings: add per-stage wall times (seconds) and the number of generated tokens to the output
+            return_heatmaps: add, per generated JSON field, a cross-attention heatmap over the encoder patch grid
+                and its bounding box (left, top, right, bottom) in input image pixels
+                (canvas pixels if image_tensors is fed without content_region), aggregated online during decoding
+            trim_padding: drop the encoder output tokens lying entirely in the canvas padding before decoding,
+                so that every decoding step cross-attends over the document content only (ignored if
+                image_tensors is fed without content_region).
+                The model was trained with padding tokens in the cross-attention softmax, so predictions
+                can change (see benchmark.py trim). Sequence lengths before/after trimming are added to the output
+            max_length: maximum length of the generated sequence (prompt included), config.max_length if None
+            content_region: content region of image_tensors as returned by encoder.prepare_input
+                (one per batch item, or a single one shared by the batch),
+                used by trim_padding and return_heatmaps when image_tensors is fed.
+                With several regions, trim_padding keeps the tokens overlapping the content of any batch item
+            use_state_cache: read and fill the state cache of the model, if enabled (see enable_state_cache)
         """
         # prepare backbone inputs (image and prompt)
         if image is None and image_tensors is None:
@@ -437,21 +1190,51 @@ class DonutModel(PreTrainedModel):
         if all(v is None for v in {prompt, prompt_tensors}):
             raise ValueError("Expected either prompt or prompt_tensors")
 
+        timings = {}
+        start = time.perf_counter()
+
         if image_tensors is None:
-            image_tensors = self.encoder.prepare_input(image).unsqueeze(0)
+            if not isinstance(image, PIL.Image.Image):
+                image = self.encoder.load_image(image)
+            image_tensors, content_region = self.encoder.prepare_input(image, return_content_region=True)
+            image_tensors = image_tensors.unsqueeze(0)
+
+        content_regions = content_region
+        if content_region is None or isinstance(content_region, dict):
+            content_regions = [content_region] * image_tensors.shape[0]
+
+        token_indices = None
+        if trim_padding and content_region is not None:
+            token_indices = torch.cat([self.encoder.content_token_indices(region) for region in content_regions])
+            token_indices = torch.unique(token_indices).to(self.device)
+
+        # decoder states of the image from a previous call (steps needing attentions are not seeded)
+        state_cache = None if return_attentions or return_heatmaps or not use_state_cache else self.state_cache
+        state = None
+        if state_cache is not None:
+            trimmed_boxes = None if token_indices is None else [region["box"] for region in content_regions]
+            state_key = state_cache.make_key(image_tensors, trimmed_boxes, str(self.dtype))
+            state = state_cache.get(state_key)
 
-        if self.device.type == "cuda":  # half is not compatible in cpu implementation.
-            image_tensors = image_tensors.half()
-            image_tensors = image_tensors.to(self.device)
+        # run in the precision the model was cast to (float32, bfloat16 or float16 on cuda)
+        image_tensors = image_tensors.to(device=self.device, dtype=self.dtype)
 
         if prompt_tensors is None:
             prompt_tensors = self.decoder.tokenizer(prompt, add_special_tokens=False, return_tensors="pt")["input_ids"]
 
         prompt_tensors = prompt_tensors.to(self.device)
+        if return_timings:
+            start = self._record_timing(timings, "preprocess", start)
 
-        last_hidden_state = self.encoder(image_tensors)
-        if self.device.type != "cuda":
-            last_hidden_state = last_hidden_state.to(torch.float32)
+        if state is not None:
+            last_hidden_state = state["last_hidden_state"]
+        else:
+            last_hidden_state = self.encoder(image_tensors)
+            last_hidden_state = last_hidden_state.to(self.decoder.model.dtype)
+            if token_indices is not None:
+                last_hidden_state = last_hidden_state[:, token_indices]
+        if return_timings:
+            start = self._record_timing(timings, "encode", start)
 
         encoder_outputs = ModelOutput(last_hidden_state=last_hidden_state, attentions=None)
 
@@ -459,28 +1242,56 @@ class DonutModel(PreTrainedModel):
             encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state.unsqueeze(0)
         if len(prompt_tensors.size()) == 1:
             prompt_tensors = prompt_tensors.unsqueeze(0)
+        if prompt_tensors.shape[0] == 1:
+            prompt_tensors = prompt_tensors.expand(last_hidden_state.shape[0], -1)
+
+        if self.decoder.vocab_shortlist is not None:
+            self.decoder.vocab_shortlist.reset_stats()
+
+        reducer = None
+        if return_heatmaps:
+            reducer = CrossAttentionHeatmap(self.decoder.tokenizer, self.encoder.output_grid, token_indices)
+        self.decoder.cross_attention_reducer = reducer
+
+        past_key_values = None
+        if state_cache is not None:
+            state_stats = {"encoder": state is not None}
+            # cached states outlive the call: never keep the autograd graph with them
+            with torch.no_grad():
+                if state is None:
+                    cross_key_values = self.decoder.cross_key_values(last_hidden_state)
+                    state = state_cache.put(state_key, last_hidden_state.detach(), cross_key_values)
+                past_key_values = self._seed_past_key_values(state, prompt_tensors, state_stats)
 
         # get decoder output
-        decoder_output = self.decoder.model.generate(
-            decoder_input_ids=prompt_tensors,
-            encoder_outputs=encoder_outputs,
-            max_length=self.config.max_length,
-            early_stopping=True,
-            pad_token_id=self.decoder.tokenizer.pad_token_id,
-            eos_token_id=self.decoder.tokenizer.eos_token_id,
-            use_cache=True,
-            num_beams=1,
-            bad_words_ids=[[self.decoder.tokenizer.unk_token_id]],
-            return_dict_in_generate=True,
-            output_attentions=return_attentions,
-            output_scores=True
-        )
+        try:
+            decoder_output = self.decoder.model.generate(
+                decoder_input_ids=prompt_tensors,
+                encoder_outputs=encoder_outputs,
+                past_key_values=past_key_values,
+                max_length=max_length or self.config.max_length,
+                early_stopping=True,
+                pad_token_id=self.decoder.tokenizer.pad_token_id,
+                eos_token_id=self.decoder.tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+                bad_words_ids=[[self.decoder.tokenizer.unk_token_id]],
+                return_dict_in_generate=True,
+                output_attentions=return_attentions,
+                output_scores=True
+            )
+        finally:
+            self.decoder.cross_attention_reducer = None
+        if return_timings:
+            start = self._record_timing(timings, "decode", start)
 
         # calcuate confidences
-        gen_sequences = decoder_output.sequences[:, prompt_tensors.shape[-1]:-1]
-        probs = torch.stack(decoder_output.scores, dim=1).softmax(-1)
-        gen_probs = torch.gather(probs, 2, gen_sequences[:, :, None]).squeeze(-1)
-        unique_prob_per_sequence = gen_probs.prod(-1)
+        unique_prob_per_sequence = sequence_confidences(
+            decoder_output.sequences,
+            decoder_output.scores,
+            prompt_tensors.shape[-1],
+            self.decoder.tokenizer.eos_token_id,
+        )
 
         output = {"predictions": list(), "confidences": unique_prob_per_sequence}
         for seq in self.decoder.tokenizer.batch_decode(decoder_output.sequences):
@@ -497,8 +1308,170 @@ class DonutModel(PreTrainedModel):
                 "cross_attentions": decoder_output.cross_attentions,
             }
 
+        if self.decoder.vocab_shortlist is not None:
+            output["vocab_shortlist"] = self.decoder.vocab_shortlist.stats()
+
+        if token_indices is not None:
+            rows, cols = self.encoder.output_grid
+            output["encoder_sequence_length"] = {"total": rows * cols, "kept": len(token_indices)}
+
+        if state_cache is not None:
+            output["state_cache"] = state_stats
+
+        if return_heatmaps:
+            output["heatmaps"] = reducer.finalize(decoder_output.sequences[:, -1])
+            for fields, region in zip(output["heatmaps"], content_regions):
+                for field in fields:
+                    box = reducer.heatmap_to_box(field["heatmap"], self.config.input_size)
+                    if region is not None:
+                        box = self.encoder.canvas_to_image_box(box, region)
+                    field["box"] = list(box)
+
+        if return_timings:
+            self._record_timing(timings, "parse", start)
+            output["timings"] = timings
+            output["num_tokens"] = int(
+                decoder_output.sequences[:, prompt_tensors.shape[-1]:].ne(self.decoder.tokenizer.pad_token_id).sum()
+            )
+
         return output
 
+    def _seed_past_key_values(self, state: dict, prompt_tensors: torch.Tensor, stats: dict):
+        """
+        KV cache of all prompt tokens but the last one, from the cached states of the image:
+        the longest cached prompt prefix is extended with the remaining prompt tokens, new prefixes are cached
+        """
+        prefix = prompt_tensors[:, :-1]
+        rows = tuple(tuple(row) for row in prefix.tolist())
+        length, past_key_values = self.state_cache.get_prefix(state, rows)
+        if past_key_values is None:
+            # cross-attention states only, empty self-attention states
+            past_key_values = tuple(
+                (key[:, :, :0], value[:, :, :0], key, value) for key, value in state["cross_key_values"]
+            )
+
+        stats["prefix_tokens"] = length
+        stats["prefill_tokens"] = prefix.shape[1] - length
+        if length < prefix.shape[1]:
+            past_key_values = self.decoder.prefill(prefix[:, length:], state["last_hidden_state"], past_key_values)
+            self.state_cache.put_prefix(state, rows, past_key_values)
+
+            # the leading special tokens (task start, question field...) are shared by the prompts of a task
+            special_ids = set(self.decoder.tokenizer.all_special_ids) | set(
+                self.decoder.tokenizer.get_added_vocab().values()
+            )
+            shared = min(next((i for i, token_id in enumerate(row) if token_id not in special_ids), len(row))
+                         for row in rows)
+            if length < shared < prefix.shape[1]:
+                self.state_cache.put_prefix(
+                    state,
+                    tuple(row[:shared] for row in rows),
+                    tuple((k[:, :, :shared], v[:, :, :shared], ck, cv) for k, v, ck, cv in past_key_values),
+                )
+        return past_key_values
+
+    def inference_pages(
+        self,
+        pages: List[Union[PIL.Image.Image, str, bytes, os.PathLike]],
+        prompt: str,
+        batch_size: int = 4,
+        confidence_threshold: float = None,
+        return_json: bool = True,
+        return_timings: bool = False,
+        return_heatmaps: bool = False,
+        trim_padding: bool = False,
+        max_length: int = None,
+    ):
+        """
+        Run the same prompt (e.g. a DocVQA question) over the pages of a multi-page document.
+        Pages are encoded and decoded in batches, one generate call per batch, and the answers of all pages
+        are ranked by sequence confidence
+
+        Args:
+            pages: page images (PIL.Image), or encoded images (file path or bytes) decoded near the canvas size
+            prompt: task prompt (string) shared by all pages
+            batch_size: number of pages encoded and decoded together
+            confidence_threshold: early exit, remaining pages are skipped once a page reaches this confidence
+            return_json, return_timings, return_heatmaps, trim_padding, max_length: see inference
+
+        Returns:
+            prediction, confidence, page: best answer, its confidence and its page index
+            candidates: page, prediction and confidence (and heatmaps) of every processed page, best first
+            num_pages, processed_pages: number of input and processed pages
+            timings, num_tokens: summed over batches (return_timings only)
+        """
+        if len(pages) == 0:
+            raise ValueError("Expected at least one page")
+
+        candidates = []
+        timings = {}
+        num_tokens = 0
+        for batch_start in range(0, len(pages), batch_size):
+            start = time.perf_counter()
+            image_tensors, content_regions = [], []
+            for page in pages[batch_start:batch_start + batch_size]:
+                if not isinstance(page, PIL.Image.Image):
+                    page = self.encoder.load_image(page)
+                image_tensor, content_region = self.encoder.prepare_input(page, return_content_region=True)
+                image_tensors.append(image_tensor)
+                content_regions.append(content_region)
+            load_time = time.perf_counter() - start
+
+            output = self.inference(
+                image_tensors=torch.stack(image_tensors),
+                prompt=prompt,
+                return_json=return_json,
+                return_timings=return_timings,
+                return_heatmaps=return_heatmaps,
+                trim_padding=trim_padding,
+                max_length=max_length,
+                content_region=content_regions,
+            )
+            for index, prediction in enumerate(output["predictions"]):
+                candidate = {
+                    "page": batch_start + index,
+                    "prediction": prediction,
+                    "confidence": float(output["confidences"][index]),
+                }
+                if return_heatmaps:
+                    candidate["heatmaps"] = output["heatmaps"][index]
+                candidates.append(candidate)
+
+            if return_timings:
+                output["timings"]["preprocess"] += load_time
+                for stage, value in output["timings"].items():
+                    timings[stage] = timings.get(stage, 0.0) + value
+                num_tokens += output["num_tokens"]
+
+            if confidence_threshold is not None and max(c["confidence"] for c in candidates) >= confidence_threshold:
+                break
+
+        # stable sort: the first page wins ties
+        candidates.sort(key=lambda candidate: candidate["confidence"], reverse=True)
+        result = {
+            "prediction": candidates[0]["prediction"],
+            "confidence": candidates[0]["confidence"],
+            "page": candidates[0]["page"],
+            "candidates": candidates,
+            "num_pages": len(pages),
+            "processed_pages": len(candidates),
+        }
+        if return_timings:
+            result["timings"] = timings
+            result["num_tokens"] = num_tokens
+        return result
+
+    def _record_timing(self, timings: dict, stage: str, start: float) -> float:
+        """
+        Store the time elapsed since start for the given stage and return the new reference time,
+        CUDA kernels are synchronized so that asynchronous work is accounted to the right stage
+        """
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        timings[stage] = now - start
+        return now
+
     def json2token(self, obj: Any, update_special_tokens_for_json_key: bool = True, sort_json_key: bool = True):
         """
         Convert an ordered JSON object into a token sequence
@@ -0,0 +1,126 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from infer_donut.model import DonutModel
+from infer_donut.model_zoo import get_task_prompt
+
+
+# Everything that defines a loaded model instance
+ModelConfig = namedtuple("ModelConfig", ["model_name", "task_name", "device", "precision", "attention_backend",
+                                         "torch_compile", "compile_cache_folder", "warmup",
+                                         "vocab_shortlist", "shortlist_corpus", "shortlist_min_count"])
+
+
+def read_shortlist_corpus(path):
+    # One expected output per line: plain text, JSON parse or Donut dataset metadata.jsonl entry
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                corpus.append(line)
+                continue
+
+            if isinstance(item, dict) and "ground_truth" in item:
+                ground_truth = json.loads(item["ground_truth"])
+                corpus.extend(ground_truth["gt_parses"] if "gt_parses" in ground_truth
+                              else [ground_truth.get("gt_parse", ground_truth)])
+            else:
+                corpus.append(item)
+    return corpus
+
+
+def load_model(config):
+    # Load, cast and optionally compile/warm up a model, returns (model, timings in seconds)
+    timings = {}
+    start = time.perf_counter()
+    print(f"Loading model {config.model_name}...")
+    model = DonutModel.from_pretrained(config.model_name, ignore_mismatched_sizes=True)
+    model.set_precision(config.precision, config.device)
+    model.set_attention_backend(config.attention_backend)
+    model.eval()
+    print("Model loaded.")
+
+    if config.vocab_shortlist:
+        if config.shortlist_corpus == "" and config.task_name != "rvlcdip":
+            # special and added tokens only: every text token would fall back to the full vocabulary
+            raise ValueError(f"Vocabulary shortlist of task {config.task_name} requires a shortlist corpus")
+        corpus = read_shortlist_corpus(config.shortlist_corpus) if config.shortlist_corpus != "" else None
+        shortlist = model.build_vocab_shortlist(corpus, config.shortlist_min_count)
+        print(f"Vocabulary shortlist: {len(shortlist.token_ids)} of {shortlist.vocab_size} tokens.")
+    timings["load"] = time.perf_counter() - start
+
+    prompt = get_task_prompt(config.task_name)
+    # process-wide artifact folder, shared by all models and workers using it
+    if config.torch_compile and model.compile_for_inference(config.compile_cache_folder or None):
+        # torch.compile is lazy: the first pass compiles (and runs) the graphs, the second one is the warmup
+        start = time.perf_counter()
+        model.warmup(prompt)
+        timings["compile"] = time.perf_counter() - start
+        print(f"Model compiled in {timings['compile']:.2f}s.")
+        timings["warmup"] = model.warmup(prompt)
+        print(f"Model warmed up in {timings['warmup']:.2f}s.")
+    elif config.warmup:
+        timings["warmup"] = model.warmup(prompt)
+        print(f"Model warmed up in {timings['warmup']:.2f}s.")
+
+    return model, timings
+
+
+# --------------------
+# - Process-wide background model loader
+# - Loads run one at a time on a worker thread, the last loaded models are kept for fast switching
+# --------------------
+class ModelLoader:
+
+    def __init__(self, max_models=2):
+        self.max_models = max_models
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer_donut_loader")
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def preload(self, config):
+        # Start loading the model in background if not already loaded or loading, returns its future
+        with self._lock:
+            future = self._futures.get(config)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._executor.submit(load_model, config)
+                self._futures[config] = future
+            self._futures.move_to_end(config)
+
+            # evict the least recently used loaded models, a model still loading is kept:
+            # dropping it would start a second full load on its next request
+            for key in list(self._futures):
+                if len(self._futures) <= self.max_models:
+                    break
+                if key != config and self._futures[key].done():
+                    del self._futures[key]
+            return future
+
+
+model_loader = ModelLoader()
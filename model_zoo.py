@@ -4,3 +4,39 @@ model_zoo = {
     'naver-clova-ix/donut-base-finetuned-cord-v1': 'cord-v1',
     'naver-clova-ix/donut-base-finetuned-cord-v2': 'cord-v2'
 }
+
+
+def get_task_prompt(task_name, question=""):
+    if task_name == "docvqa":
+        return f"<s_{task_name}><s_question>{question.lower()}</s_question><s_answer>"
+    return f"<s_{task_name}>"
+
+
+# Cascade mode: the classifier runs first, then the document is routed to the extractor mapped to its class.
+# Classes without mapping are not extracted.
+cascade_classifier = 'naver-clova-ix/donut-base-finetuned-rvlcdip'
+cascade_routes = {
+    'invoice': 'naver-clova-ix/donut-base-finetuned-cord-v2',
+    'form': 'naver-clova-ix/donut-base-finetuned-docvqa',
+    'letter': 'naver-clova-ix/donut-base-finetuned-docvqa',
+    'memo': 'naver-clova-ix/donut-base-finetuned-docvqa',
+    'questionnaire': 'naver-clova-ix/donut-base-finetuned-docvqa'
+}
+
+
+def parse_cascade_routes(routes):
+    # "class=model_name;class=model_name" -> dict, default routes if empty
+    if routes.strip() == "":
+        return dict(cascade_routes)
+
+    table = {}
+    for route in routes.split(";"):
+        if route.strip() == "":
+            continue
+        if "=" not in route:
+            raise ValueError(f"Cascade route {route.strip()}: expected class=model_name")
+        doc_class, model_name = (item.strip() for item in route.split("=", 1))
+        if model_name not in model_zoo:
+            raise ValueError(f"Cascade route {doc_class}: {model_name} is not a model of the model zoo")
+        table[doc_class] = model_name
+    return table
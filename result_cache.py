@@ -0,0 +1,173 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+# --------------------
+# - Persistent result cache stored in a SQLite database
+# - Safe for several threads and worker processes sharing the same folder (WAL journal, busy timeout)
+# - Hits are read-only: access times are buffered in memory and written in batches,
+# - the total size is maintained by triggers so that eviction checks do not scan the table
+# --------------------
+class ResultCache:
+
+    def __init__(self, folder, ttl=0, max_size_mb=512, access_flush_count=64, access_flush_interval=5.0):
+        # ttl: entry lifetime in seconds (0: never expires)
+        # max_size_mb: least recently used entries are evicted above this size (0: unbounded)
+        # access_flush_count/interval: buffered access times are written after this many hits or seconds
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.path = os.path.join(folder, "infer_donut_results.sqlite")
+        self.ttl = ttl
+        self.max_size = max_size_mb * 2 ** 20
+        self.access_flush_count = access_flush_count
+        self.access_flush_interval = access_flush_interval
+        self._local = threading.local()
+        self._accessed = {}
+        self._accessed_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                         "created REAL NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+            # running total of the entry sizes, initialized from existing entries
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "total_size INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO stats (id, total_size) "
+                         "SELECT 0, COALESCE(SUM(size), 0) FROM results")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN "
+                         "UPDATE stats SET total_size = total_size + NEW.size WHERE id = 0; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN "
+                         "UPDATE stats SET total_size = total_size - OLD.size WHERE id = 0; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results BEGIN "
+                         "UPDATE stats SET total_size = total_size + NEW.size - OLD.size WHERE id = 0; END")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connection(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(image, **identity):
+        # image: numpy array, identity: model identity/version, task, prompt and any output-affecting option
+        h = hashlib.blake2b(digest_size=32)
+        h.update(str((image.shape, image.dtype.str)).encode())
+        h.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+        h.update(json.dumps(identity, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        now = time.time()
+        if self.ttl > 0 and now - row[1] > self.ttl:
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+
+        with self._accessed_lock:
+            self._accessed[key] = now
+            flush = (len(self._accessed) >= self.access_flush_count or
+                     time.monotonic() - self._last_flush >= self.access_flush_interval)
+        if flush:
+            self.flush_accesses()
+        return json.loads(row[0])
+
+    def flush_accesses(self):
+        # Write the buffered access times (LRU order) in one transaction
+        with self._accessed_lock:
+            accessed = self._accessed
+            self._accessed = {}
+            self._last_flush = time.monotonic()
+        if accessed:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("UPDATE results SET accessed = ? WHERE key = ?",
+                                 [(t, key) for key, t in accessed.items()])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def total_size(self):
+        return self._connection().execute("SELECT total_size FROM stats WHERE id = 0").fetchone()[0]
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        now = time.time()
+        conn = self._connection()
+        conn.execute("INSERT INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                     "created = excluded.created, accessed = excluded.accessed",
+                     (key, data, len(data), now, now))
+        self.evict()
+
+    def evict(self):
+        conn = self._connection()
+        if self.ttl > 0:
+            conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+
+        if self.max_size > 0:
+            total = self.total_size()
+            if total > self.max_size:
+                self.flush_accesses()
+                # drop least recently used entries until the cache is back under 90% of its size limit
+                excess = total - int(0.9 * self.max_size)
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    removed = 0
+                    for key, size in conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+                        if removed >= excess:
+                            break
+                        conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                        removed += size
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+    def clear(self):
+        with self._accessed_lock:
+            self._accessed = {}
+        self._connection().execute("DELETE FROM results")
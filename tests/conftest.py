@@ -0,0 +1,13 @@
+import importlib.util
+import os
+import sys
+
+# Plugin modules import each other as the infer_donut package, whatever the name of the checkout folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "infer_donut" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("infer_donut", os.path.join(ROOT, "__init__.py"),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["infer_donut"] = module
+    spec.loader.exec_module(module)
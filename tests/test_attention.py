@@ -0,0 +1,97 @@
+import types
+
+import pytest
+import torch
+from timm.models.swin_transformer import SwinTransformerBlock
+from transformers.models.mbart.modeling_mbart import MBartAttention
+
+from infer_donut.model import sdpa_mbart_attention_forward, sdpa_window_attention_forward
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+def test_window_attention_shifted():
+    # randomly initialized block with shifted windows: 4 windows of 4 x 4 tokens
+    block = SwinTransformerBlock(dim=32, input_resolution=(8, 8), num_heads=4, window_size=4, shift_size=2).eval()
+    attn = block.attn
+    torch.nn.init.normal_(attn.relative_position_bias_table)
+    mask = block.attn_mask
+    assert mask is not None and bool((mask != 0).any())
+
+    x = torch.randn(2 * mask.shape[0], 16, 32)
+    with torch.no_grad():
+        expected = type(attn).forward(attn, x, mask)
+        attn.forward = types.MethodType(sdpa_window_attention_forward, attn)
+        assert torch.allclose(attn(x, mask), expected, atol=1e-5)
+        assert torch.allclose(attn(x), type(attn).forward(attn, x), atol=1e-5)
+
+        # whole block, which builds the windows and passes its mask
+        tokens = torch.randn(2, 64, 32)
+        patched = block(tokens)
+        del attn.forward
+        assert torch.allclose(patched, block(tokens), atol=1e-5)
+
+
+def make_attention():
+    attn = MBartAttention(embed_dim=32, num_heads=4, is_decoder=True).eval()
+    sdpa = types.MethodType(sdpa_mbart_attention_forward, attn)
+    return attn, sdpa
+
+
+def causal_mask(bsz, tgt_len, past_len):
+    # additive decoder mask as built by MBartDecoder: (bsz, 1, tgt_len, past_len + tgt_len)
+    mask = torch.full((tgt_len, past_len + tgt_len), float("-inf")).triu(past_len + 1)
+    return mask[None, None].expand(bsz, 1, -1, -1)
+
+
+def test_mbart_self_attention_with_cache():
+    attn, sdpa = make_attention()
+    bsz, past_len = 2, 5
+    with torch.no_grad():
+        prompt = torch.randn(bsz, past_len, 32)
+        expected, _, expected_past = type(attn).forward(attn, prompt, attention_mask=causal_mask(bsz, past_len, 0))
+        output, weights, past = sdpa(prompt, attention_mask=causal_mask(bsz, past_len, 0))
+        assert weights is None
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert all(torch.allclose(a, b) for a, b in zip(past, expected_past))
+
+        # next decoding step with the KV cache
+        step = torch.randn(bsz, 1, 32)
+        expected, _, expected_past = type(attn).forward(
+            attn, step, past_key_value=expected_past, attention_mask=causal_mask(bsz, 1, past_len)
+        )
+        output, _, past = sdpa(step, past_key_value=past, attention_mask=causal_mask(bsz, 1, past_len))
+        assert past[0].shape[2] == past_len + 1
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert all(torch.allclose(a, b) for a, b in zip(past, expected_past))
+
+
+def test_mbart_cross_attention():
+    attn, sdpa = make_attention()
+    bsz = 2
+    with torch.no_grad():
+        encoder_states = torch.randn(bsz, 12, 32)
+        hidden_states = torch.randn(bsz, 3, 32)
+        expected, _, expected_past = type(attn).forward(attn, hidden_states, key_value_states=encoder_states)
+        output, _, past = sdpa(hidden_states, key_value_states=encoder_states)
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert all(torch.allclose(a, b) for a, b in zip(past, expected_past))
+
+        # cached cross-attention keys and values are reused
+        step = torch.randn(bsz, 1, 32)
+        expected, _, _ = type(attn).forward(attn, step, key_value_states=encoder_states, past_key_value=expected_past)
+        output, _, reused = sdpa(step, key_value_states=encoder_states, past_key_value=past)
+        assert reused[0] is past[0] and reused[1] is past[1]
+        assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_mbart_attention_weights_fall_back_to_eager():
+    attn, sdpa = make_attention()
+    hidden_states = torch.randn(1, 4, 32)
+    with torch.no_grad():
+        output, weights, _ = sdpa(hidden_states, output_attentions=True)
+        expected, expected_weights, _ = type(attn).forward(attn, hidden_states, output_attentions=True)
+    assert torch.allclose(output, expected) and torch.allclose(weights, expected_weights)
@@ -0,0 +1,83 @@
+import numpy as np
+
+from infer_donut.frame_dedup import FrameDeduplicator, frame_signature
+
+
+def make_frame(seed, noise=0):
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (256, 256, 3)).astype(np.int16)
+    if noise:
+        img += rng.integers(-noise, noise + 1, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def test_signature_ignores_brightness():
+    img = make_frame(0).astype(np.int16)
+    darker = np.clip(img - 10, 0, 255).astype(np.uint8)
+    assert np.abs(frame_signature(img.astype(np.uint8)) - frame_signature(darker)).mean() < 0.01
+
+
+def test_threshold():
+    dedup = FrameDeduplicator(threshold=0.02)
+    frame = make_frame(0)
+    result, signature = dedup.lookup(frame)
+    assert result is None
+    dedup.update(signature, {"answer": "x"})
+
+    result, _ = dedup.lookup(make_frame(0, noise=2))
+    assert result == {"answer": "x"}
+    result, _ = dedup.lookup(make_frame(1))
+    assert result is None
+
+    dedup.threshold = 1.0
+    result, _ = dedup.lookup(make_frame(1))
+    assert result == {"answer": "x"}
+    assert dedup.stats() == {"frames": 4, "reused": 2, "reuse_rate": 0.5}
+
+
+def test_result_is_copied():
+    dedup = FrameDeduplicator()
+    _, signature = dedup.lookup(make_frame(0))
+    prediction = {"answer": "x"}
+    dedup.update(signature, prediction)
+    prediction["answer"] = "y"
+
+    result, _ = dedup.lookup(make_frame(0))
+    result["answer"] = "z"
+    assert dedup.lookup(make_frame(0))[0] == {"answer": "x"}
+
+
+def test_throttle(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr("infer_donut.frame_dedup.time.perf_counter", lambda: now)
+    dedup = FrameDeduplicator(threshold=0.02, max_rate=2.0)
+    _, signature = dedup.lookup(make_frame(0))
+    dedup.update(signature, {"answer": "x"})
+
+    # changed frame within 1 / max_rate of the last inference: previous result is reused
+    now = 100.4
+    result, _ = dedup.lookup(make_frame(1))
+    assert result == {"answer": "x"}
+
+    now = 100.6
+    result, _ = dedup.lookup(make_frame(1))
+    assert result is None
+
+
+def test_key_change():
+    dedup = FrameDeduplicator(threshold=1.0, max_rate=1000.0)
+    _, signature = dedup.lookup(make_frame(0), key={"model": "a"})
+    dedup.update(signature, {"answer": "x"}, key={"model": "a"})
+
+    assert dedup.lookup(make_frame(0), key={"model": "a"})[0] == {"answer": "x"}
+    # a new key always requires an inference, even when throttled or unchanged
+    assert dedup.lookup(make_frame(0), key={"model": "b"})[0] is None
+
+
+def test_reset():
+    dedup = FrameDeduplicator()
+    _, signature = dedup.lookup(make_frame(0))
+    dedup.update(signature, {"answer": "x"})
+    dedup.reset()
+    assert dedup.lookup(make_frame(0))[0] is None
+    assert dedup.stats()["frames"] == 1
@@ -0,0 +1,73 @@
+import logging
+
+from infer_donut.metrics import LoggerSink, PrometheusFileSink, RunMetrics
+
+
+def make_metrics(model_name, task_name, hit, background=None):
+    metrics = RunMetrics(model_name, task_name)
+    metrics.add_timing("decode", 0.5)
+    metrics.add_tokens(10)
+    metrics.record_cache("result", hit)
+    if background:
+        metrics.add_background_timings(model_name, background)
+    return metrics.to_dict()
+
+
+def read_samples(path):
+    samples = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+    return samples
+
+
+def test_prometheus_series_accumulation(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    sink = PrometheusFileSink(path)
+    sink.export(make_metrics("a", "cord", False, {"load": 2.0, "warmup": 1.0}))
+    sink.export(make_metrics("a", "cord", True))
+    sink.export(make_metrics("a", "cord", True))
+    sink.export(make_metrics("b", "docvqa", False))
+
+    samples = read_samples(path)
+    a, b = 'model="a",task="cord"', 'model="b",task="docvqa"'
+    assert samples[f"infer_donut_runs_total{{{a}}}"] == 3
+    assert samples[f"infer_donut_runs_total{{{b}}}"] == 1
+    assert samples[f"infer_donut_generated_tokens_total{{{a}}}"] == 30
+    assert samples[f'infer_donut_stage_seconds_total{{{a},stage="decode"}}'] == 1.5
+    assert samples[f'infer_donut_cache_hits_total{{{a},cache="result"}}'] == 2
+    assert samples[f'infer_donut_cache_misses_total{{{a},cache="result"}}'] == 1
+    assert samples[f'infer_donut_cache_misses_total{{{b},cache="result"}}'] == 1
+    assert samples[f'infer_donut_background_stage_seconds_total{{{a},loaded_model="a",stage="load"}}'] == 2.0
+    assert samples[f'infer_donut_background_stage_seconds_total{{{a},loaded_model="a",stage="warmup"}}'] == 1.0
+    # background timings are not run stages
+    assert f'infer_donut_stage_seconds_total{{{a},stage="load"}}' not in samples
+
+
+def test_prometheus_single_type_line_per_metric(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    sink = PrometheusFileSink(path)
+    sink.export(make_metrics("a", "cord", False))
+    sink.export(make_metrics("b", "cord", False))
+    with open(path) as f:
+        type_lines = [line.split()[2] for line in f if line.startswith("# TYPE")]
+    assert len(type_lines) == len(set(type_lines))
+    assert "infer_donut_cache_hits_total" in type_lines
+
+
+def test_prometheus_label_escaping(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    sink = PrometheusFileSink(path)
+    sink.export(make_metrics('C:\\models\\"donut"\nv2', "cord", False))
+    samples = read_samples(path)
+    assert samples['infer_donut_runs_total{model="C:\\\\models\\\\\\"donut\\"\\nv2",task="cord"}'] == 1
+
+
+def test_logger_sink_background_timings(caplog):
+    sink = LoggerSink()
+    with caplog.at_level(logging.INFO):
+        sink.export(make_metrics("a", "cord", False, {"load": 2.0}))
+    assert "decode=500.0ms" in caplog.text
+    assert "background [a] (load=2000.0ms)" in caplog.text
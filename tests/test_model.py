@@ -0,0 +1,223 @@
+import pytest
+import torch
+from PIL import Image
+
+from infer_donut.model import (CrossAttentionHeatmap, SwinEncoder, VocabShortlist, canvas_scale,
+                               sequence_confidences)
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    # small randomly initialized encoder: canvas of 64 x 96 pixels, output grid of 2 x 3 tokens
+    return SwinEncoder(input_size=[64, 96], align_long_axis=True, window_size=2, encoder_layer=[1, 1, 1, 1],
+                       name_or_path="random")
+
+
+@pytest.mark.parametrize("size", [(96, 64), (48, 32), (300, 100), (100, 300), (50, 200), (1000, 999)])
+@pytest.mark.parametrize("align_long_axis", [False, True])
+def test_canvas_scale(encoder, size, align_long_axis):
+    encoder.align_long_axis = align_long_axis
+    _, content_region = encoder.prepare_input(Image.new("RGB", size), return_content_region=True)
+    encoder.align_long_axis = True
+
+    scale = canvas_scale(size, encoder.input_size, align_long_axis)
+    # prepare_input rounds the resized image to whole pixels
+    width, height = size[::-1] if content_region["rotated"] else size
+    assert scale * width == pytest.approx(content_region["scale"][0] * width, abs=1.0)
+    assert scale * height == pytest.approx(content_region["scale"][1] * height, abs=1.0)
+
+
+@pytest.mark.parametrize("box, expected", [
+    ((0, 0, 96, 64), [0, 1, 2, 3, 4, 5]),
+    ((37, 0, 58, 64), [1, 4]),
+    ((0, 0, 96, 20), [0, 1, 2]),
+    ((10, 40, 40, 64), [3, 4]),
+    ((0, 16, 96, 48), [0, 1, 2, 3, 4, 5]),
+])
+def test_content_token_indices(encoder, box, expected):
+    assert encoder.content_token_indices({"box": box}).tolist() == expected
+
+
+@pytest.mark.parametrize("size, box", [((200, 100), (40, 20, 80, 60)), ((100, 200), (20, 40, 60, 120))])
+def test_canvas_to_image_box(encoder, size, box):
+    # white rectangle on black image, found back in the (black padded) canvas then mapped to the image
+    img = Image.new("RGB", size)
+    img.paste((255, 255, 255), box)
+    image_tensor, content_region = encoder.prepare_input(img, return_content_region=True)
+    assert content_region["rotated"] == (size[0] < size[1])
+
+    rows, cols = (image_tensor[0] > 0).nonzero(as_tuple=True)
+    canvas_box = (cols.min().item(), rows.min().item(), cols.max().item() + 1, rows.max().item() + 1)
+    image_box = SwinEncoder.canvas_to_image_box(canvas_box, content_region)
+    # one canvas pixel covers about 1 / scale image pixels
+    assert image_box == pytest.approx(list(box), abs=2.0 / min(content_region["scale"]))
+
+
+def test_canvas_to_image_box_clips_padding(encoder):
+    _, content_region = encoder.prepare_input(Image.new("RGB", (200, 100)), return_content_region=True)
+    assert SwinEncoder.canvas_to_image_box((0, 0, 96, 64), content_region) == pytest.approx([0, 0, 200, 100], abs=1.0)
+
+
+def make_scores(probs):
+    # logits whose softmax gives the (steps, batch, vocab) probabilities
+    return tuple(torch.tensor(step).log() for step in probs)
+
+
+def test_sequence_confidences_single():
+    eos = 2
+    sequences = torch.tensor([[0, 1, 3, eos]])
+    scores = make_scores([[[0.1, 0.8, 0.0, 0.1]], [[0.1, 0.1, 0.2, 0.6]], [[0.0, 0.0, 0.5, 0.5]]])
+    # eos (last token) is left out
+    assert sequence_confidences(sequences, scores, 1, eos).tolist() == pytest.approx([0.8 * 0.6])
+
+
+def test_sequence_confidences_no_eos():
+    sequences = torch.tensor([[0, 3, 1]])
+    scores = make_scores([[[0.1, 0.1, 0.1, 0.7]], [[0.5, 0.2, 0.1, 0.2]]])
+    # generation stopped at max length: the last token is left out as for a single sequence
+    assert sequence_confidences(sequences, scores, 1, 2).tolist() == pytest.approx([0.7])
+
+
+def test_sequence_confidences_batch():
+    eos, pad = 2, 1
+    # the first sequence finished one step before the second one and was padded
+    sequences = torch.tensor([[0, 3, eos, pad], [0, 3, 3, eos]])
+    scores = make_scores([
+        [[0.1, 0.0, 0.1, 0.8], [0.1, 0.1, 0.1, 0.7]],
+        [[0.1, 0.1, 0.6, 0.2], [0.1, 0.1, 0.3, 0.5]],
+        [[0.1, 0.3, 0.3, 0.3], [0.1, 0.1, 0.6, 0.2]],
+    ])
+    confidences = sequence_confidences(sequences, scores, 1, eos)
+    assert confidences.tolist() == pytest.approx([0.8, 0.7 * 0.5])
+
+    # same confidence as when the first sequence is generated alone
+    single = sequence_confidences(sequences[:1, :3], tuple(step[:1] for step in scores[:2]), 1, eos)
+    assert single[0].item() == pytest.approx(confidences[0].item())
+
+
+def make_lm_head(weight, bias=None):
+    lm_head = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    with torch.no_grad():
+        lm_head.weight.copy_(weight)
+        if bias is not None:
+            lm_head.bias.copy_(bias)
+    return lm_head
+
+
+def test_vocab_shortlist_falls_back_to_excluded_token():
+    # excluded token 0 wins with the full projection although token 1 is confident within the shortlist
+    weight = torch.tensor([[3.0, 0.0], [1.0, 0.0], [0.0, 1.0], [-1.0, 0.0], [0.0, -1.0], [0.5, 0.5]])
+    lm_head = make_lm_head(weight)
+    shortlist = VocabShortlist(lm_head, [1, 2, 3, 4])
+    hidden_states = torch.tensor([[[2.0, 0.0]]])
+
+    logits = shortlist(hidden_states, lm_head)
+    assert logits.argmax(-1).item() == lm_head(hidden_states).argmax(-1).item() == 0
+    assert shortlist.stats()["fallbacks"] == 1
+
+
+def test_vocab_shortlist_keeps_shortlisted_argmax():
+    # excluded rows are small: the best shortlisted logit is above their bound
+    weight = torch.tensor([[0.1, 0.0], [4.0, 0.0], [0.0, 1.0], [0.0, 0.1]])
+    bias = torch.tensor([0.0, 0.5, 0.0, 0.2])
+    lm_head = make_lm_head(weight, bias)
+    shortlist = VocabShortlist(lm_head, [1, 2])
+    hidden_states = torch.tensor([[[1.0, 0.0], [2.0, 1.0]]])
+
+    logits = shortlist(hidden_states, lm_head)
+    full_logits = lm_head(hidden_states)
+    assert shortlist.stats() == {"size": 2, "steps": 1, "fallbacks": 0, "fallback_rate": 0.0}
+    assert torch.allclose(logits[..., [1, 2]], full_logits[..., [1, 2]])
+    assert torch.isinf(logits[..., [0, 3]]).all()
+    assert logits[:, -1].argmax(-1).item() == full_logits[:, -1].argmax(-1).item() == 1
+
+
+def test_vocab_shortlist_same_greedy_tokens():
+    torch.manual_seed(0)
+    lm_head = make_lm_head(torch.randn(50, 16), torch.randn(50) * 0.1)
+    # a few strong tokens in the shortlist, as special tokens and frequent corpus tokens
+    with torch.no_grad():
+        lm_head.weight[:10] *= 4
+    shortlist = VocabShortlist(lm_head, list(range(10)))
+    for _ in range(200):
+        hidden_states = torch.randn(2, 3, 16)
+        logits = shortlist(hidden_states, lm_head)
+        assert torch.equal(logits[:, -1].argmax(-1), lm_head(hidden_states)[:, -1].argmax(-1))
+    stats = shortlist.stats()
+    assert stats["steps"] == 200 and 0 < stats["fallbacks"] < 200
+
+
+def test_vocab_shortlist_full_vocabulary():
+    lm_head = make_lm_head(torch.randn(5, 4), torch.randn(5))
+    shortlist = VocabShortlist(lm_head, list(range(5)))
+    hidden_states = torch.randn(1, 1, 4)
+    assert torch.allclose(shortlist(hidden_states, lm_head), lm_head(hidden_states))
+    assert shortlist.fallbacks == 0
+
+
+class HeatmapTokenizer:
+    # vocabulary and special token ids, as used by CrossAttentionHeatmap
+    vocab = ["<s>", "<pad>", "</s>", "<unk>", "<s_cord-v2>", "<s_docvqa>", "<s_menu>", "</s_menu>", "<s_nm>",
+             "</s_nm>", "<sep/>", "<s_total>", "</s_total>", "<s_question>", "</s_question>", "<s_answer>",
+             "</s_answer>", "\u2581cake", "\u2581tea", "\u258112"]
+    bos_token_id = cls_token_id = 0
+    pad_token_id = 1
+    eos_token_id = sep_token_id = 2
+    unk_token_id = 3
+    mask_token_id = None
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.vocab[token_id]
+
+    def ids(self, tokens):
+        return [self.vocab.index(token) for token in tokens]
+
+
+def run_heatmap(prompt, generated, grid=(3, 4), token_indices=None, flush=True):
+    # the attention of step j is one-hot on encoder token j, it belongs to the j-th generated token
+    tokenizer = HeatmapTokenizer()
+    reducer = CrossAttentionHeatmap(tokenizer, grid, token_indices)
+    encoder_length = grid[0] * grid[1] if token_indices is None else len(token_indices)
+
+    def cross_attentions(step, sequence_length):
+        attention = torch.zeros(1, 2, sequence_length, encoder_length)
+        attention[..., -1, step] = 1.0
+        return attention, attention
+
+    prompt_ids = torch.tensor([tokenizer.ids(prompt)])
+    reducer.update(prompt_ids, cross_attentions(0, prompt_ids.shape[1]))
+    generated_ids = tokenizer.ids(generated)
+    for step, token_id in enumerate(generated_ids[:-1], 1):
+        reducer.update(torch.tensor([[token_id]]), cross_attentions(step, 1))
+    heatmaps = reducer.finalize(torch.tensor(generated_ids[-1:]) if flush else None)
+    assert len(heatmaps) == 1
+    return [(field["field"], field["heatmap"].flatten().nonzero().flatten().tolist()) for field in heatmaps[0]]
+
+
+def test_heatmap_nested_list_fields():
+    generated = ["<s_menu>", "<s_nm>", "\u2581cake", "</s_nm>", "<sep/>", "<s_nm>", "\u2581tea", "\u2581tea",
+                 "</s_nm>", "</s_menu>", "</s>"]
+    # task token skipped, one entry per list item, attention of step j attributed to the j-th generated token
+    assert run_heatmap(["<s_cord-v2>"], generated) == [("menu.nm", [2]), ("menu.nm", [6, 7])]
+
+
+def test_heatmap_prompt_fields_and_text():
+    # prompt tokens open fields but have no attention: the question field is left out
+    prompt = ["<s_docvqa>", "<s_question>", "\u2581tea", "</s_question>", "<s_answer>"]
+    assert run_heatmap(prompt, ["\u2581cake", "</s_answer>", "</s>"]) == [("answer", [0])]
+    # text outside any field is returned by token2json as text_sequence
+    assert run_heatmap(["<s_cord-v2>"], ["\u2581cake", "</s>"]) == [("text_sequence", [0])]
+
+
+def test_heatmap_flush_at_max_length():
+    # generation stopped by max_length: the last value token has no following step
+    generated = ["<s_total>", "\u258112", "\u258112"]
+    assert run_heatmap(["<s_cord-v2>"], generated) == [("total", [1, 2])]
+    assert run_heatmap(["<s_cord-v2>"], generated, flush=False) == [("total", [1])]
+
+
+def test_heatmap_token_indices():
+    # trimmed encoder output: heatmaps are scattered back onto the full grid
+    fields = run_heatmap(["<s_cord-v2>"], ["<s_total>", "\u258112", "</s_total>", "</s>"],
+                         token_indices=torch.tensor([4, 5, 6, 7]))
+    assert fields == [("total", [5])]
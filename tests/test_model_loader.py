@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+from infer_donut import model_loader as loader_module
+from infer_donut.model_loader import ModelLoader
+
+
+class FakeLoad:
+    # load_model replacement counting loads per config, blocked until released when asked
+    def __init__(self):
+        self.calls = []
+        self.blocked = {}
+        self.failures = set()
+
+    def block(self, config):
+        self.blocked[config] = threading.Event()
+        return self.blocked[config]
+
+    def __call__(self, config):
+        self.calls.append(config)
+        if config in self.blocked:
+            assert self.blocked[config].wait(5)
+        if config in self.failures:
+            self.failures.discard(config)
+            raise RuntimeError(f"cannot load {config}")
+        return f"model {config}", {"load": 0.0}
+
+
+@pytest.fixture
+def fake_load(monkeypatch):
+    fake = FakeLoad()
+    monkeypatch.setattr(loader_module, "load_model", fake)
+    return fake
+
+
+def test_preload_deduplication(fake_load):
+    loader = ModelLoader()
+    release = fake_load.block("a")
+    first = loader.preload("a")
+    # requested again while loading, then once loaded: a single load
+    assert loader.preload("a") is first
+    release.set()
+    assert first.result(5) == ("model a", {"load": 0.0})
+    assert loader.preload("a") is first
+    assert fake_load.calls == ["a"]
+
+
+def test_retry_after_failure(fake_load):
+    loader = ModelLoader()
+    fake_load.failures.add("a")
+    failed = loader.preload("a")
+    with pytest.raises(RuntimeError):
+        failed.result(5)
+
+    retried = loader.preload("a")
+    assert retried is not failed
+    assert retried.result(5)[0] == "model a"
+    assert fake_load.calls == ["a", "a"]
+
+
+def test_eviction_keeps_loading_models(fake_load):
+    loader = ModelLoader(max_models=1)
+    release = fake_load.block("a")
+    loading = loader.preload("a")
+    # "a" is still loading when "b" is requested: it is not evicted, so it is not loaded twice
+    second = loader.preload("b")
+    assert loader.preload("a") is loading
+    release.set()
+    second.result(5)
+    assert fake_load.calls == ["a", "b"]
+
+    # once loaded, the least recently used models are evicted
+    loader.preload("c").result(5)
+    assert loader.preload("c").result(5)[0] == "model c"
+    loader.preload("a").result(5)
+    assert fake_load.calls == ["a", "b", "c", "a"]
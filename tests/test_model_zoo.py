@@ -0,0 +1,27 @@
+import pytest
+
+from infer_donut.model_zoo import cascade_routes, parse_cascade_routes
+
+
+def test_default_routes():
+    assert parse_cascade_routes("") == cascade_routes
+    assert parse_cascade_routes("  ") is not cascade_routes
+
+
+def test_custom_routes():
+    routes = parse_cascade_routes(" invoice = naver-clova-ix/donut-base-finetuned-cord-v2 ;;"
+                                  "form=naver-clova-ix/donut-base-finetuned-docvqa;")
+    assert routes == {
+        "invoice": "naver-clova-ix/donut-base-finetuned-cord-v2",
+        "form": "naver-clova-ix/donut-base-finetuned-docvqa",
+    }
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError, match="not a model of the model zoo"):
+        parse_cascade_routes("invoice=some/model")
+
+
+def test_missing_separator():
+    with pytest.raises(ValueError, match="expected class=model_name"):
+        parse_cascade_routes("invoice")
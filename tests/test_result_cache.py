@@ -0,0 +1,81 @@
+import numpy as np
+
+from infer_donut.result_cache import ResultCache
+
+
+def test_put_get(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put("a", {"prediction": {"answer": "x"}, "confidence": 0.9})
+    assert cache.get("a") == {"prediction": {"answer": "x"}, "confidence": 0.9}
+    assert cache.get("b") is None
+
+
+def test_shared_between_instances(tmp_path):
+    ResultCache(str(tmp_path)).put("a", 1)
+    assert ResultCache(str(tmp_path)).get("a") == 1
+
+
+def test_ttl_expiry(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), ttl=10)
+    now = 1000.0
+    monkeypatch.setattr("infer_donut.result_cache.time.time", lambda: now)
+    cache.put("a", 1)
+    now = 1009.0
+    assert cache.get("a") == 1
+    now = 1011.0
+    assert cache.get("a") is None
+    assert cache.total_size() == 0
+
+
+def test_lru_eviction(tmp_path, monkeypatch):
+    # 1MB limit, 300KB entries: the fourth entry evicts the least recently used one
+    cache = ResultCache(str(tmp_path), max_size_mb=1, access_flush_count=1)
+    now = 1000.0
+    monkeypatch.setattr("infer_donut.result_cache.time.time", lambda: now)
+    value = "x" * 300 * 1024
+    for key in ("a", "b", "c"):
+        cache.put(key, value)
+        now += 1
+    assert cache.get("a") == value  # "b" becomes the least recently used entry
+    now += 1
+    cache.put("d", value)
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) == value for key in ("a", "c", "d"))
+    assert cache.total_size() <= 1024 * 1024
+
+
+def test_size_total_follows_replace_and_clear(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put("a", "x" * 100)
+    cache.put("a", "x" * 10)
+    assert cache.total_size() == len('"' + "x" * 10 + '"')
+    cache.clear()
+    assert cache.total_size() == 0
+
+
+def test_buffered_accesses_are_flushed(tmp_path):
+    cache = ResultCache(str(tmp_path), access_flush_count=2, access_flush_interval=3600)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    accessed = dict(cache._connection().execute("SELECT key, accessed FROM results").fetchall())
+    cache.get("a")
+    assert dict(cache._connection().execute("SELECT key, accessed FROM results").fetchall()) == accessed
+    cache.get("b")
+    updated = dict(cache._connection().execute("SELECT key, accessed FROM results").fetchall())
+    assert updated["a"] >= accessed["a"] and updated["b"] >= accessed["b"]
+    assert cache._accessed == {}
+
+
+def test_key_sensitivity():
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+    key = ResultCache.make_key(image, model="m", prompt="p")
+    assert key == ResultCache.make_key(image.copy(), prompt="p", model="m")
+
+    other = image.copy()
+    other[0, 0, 0] = 1
+    assert key != ResultCache.make_key(other, model="m", prompt="p")
+    assert key != ResultCache.make_key(image.reshape(8, 2, 3), model="m", prompt="p")
+    assert key != ResultCache.make_key(image.astype(np.uint16), model="m", prompt="p")
+    assert key != ResultCache.make_key(image, model="m", prompt="q")
+    assert key != ResultCache.make_key(image, model="m", prompt="p", attention_backend="sdpa")
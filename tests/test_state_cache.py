@@ -0,0 +1,128 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from infer_donut.model import DecoderStateCache, DonutConfig, DonutModel
+
+sentencepiece = pytest.importorskip("sentencepiece")
+
+PROMPT = "<s_docvqa><s_question>{}</s_question><s_answer>"
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    # tiny randomly initialized model with a local tokenizer: no download
+    folder = tmp_path_factory.mktemp("donut")
+    text = ["what is the date of the invoice", "total amount due 12.50", "name address phone number",
+            "question answer document menu price", "the quick brown fox jumps over the lazy dog"] * 20
+    spm_model = io.BytesIO()
+    sentencepiece.SentencePieceTrainer.train(sentence_iterator=iter(text), model_writer=spm_model, vocab_size=60,
+                                             hard_vocab_limit=False)
+    (folder / "sentencepiece.bpe.model").write_bytes(spm_model.getvalue())
+
+    torch.manual_seed(0)
+    config = DonutConfig(input_size=[64, 128], window_size=2, encoder_layer=[1, 1, 1, 1], decoder_layer=2,
+                         max_length=24, name_or_path=str(folder))
+    model = DonutModel(config).eval()
+    model.decoder.add_special_tokens(["<s_docvqa>", "<s_question>", "</s_question>", "<s_answer>", "</s_answer>"])
+    # default init gives near uniform logits: spread the decoder weights so that generation varies
+    with torch.no_grad():
+        for weight in model.decoder.parameters():
+            weight.normal_(0, 0.3)
+    return model
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (80, 120, 3), dtype=np.uint8)) for _ in range(2)]
+
+
+def test_cached_outputs_match(model, images):
+    model.enable_state_cache(0)
+    model.enable_state_cache(2)
+    runs = [(0, "what is the date"), (0, "what is the date"), (0, "total amount"), (1, "total amount"),
+            (0, "total amount due")]
+    expected_stats = [
+        {"encoder": False, "prefix_tokens": 0},
+        {"encoder": True, "prefill_tokens": 0},
+        {"encoder": True, "prefix_tokens": 2},  # shared <s_docvqa><s_question> entry
+        {"encoder": False, "prefix_tokens": 0},
+        {"encoder": True},
+    ]
+    with torch.no_grad():
+        for (image, question), stats in zip(runs, expected_stats):
+            cached = model.inference(image=images[image], prompt=PROMPT.format(question), return_json=False)
+            uncached = model.inference(image=images[image], prompt=PROMPT.format(question), return_json=False,
+                                       use_state_cache=False)
+            assert "state_cache" not in uncached
+            assert cached["predictions"] == uncached["predictions"]
+            assert torch.allclose(cached["confidences"], uncached["confidences"], atol=1e-6)
+            assert stats.items() <= cached["state_cache"].items()
+
+
+def test_resize_keeps_states(model, images):
+    model.enable_state_cache(1)
+    with torch.no_grad():
+        model.inference(image=images[0], prompt=PROMPT.format("what is the date"))
+        model.enable_state_cache(2)
+        output = model.inference(image=images[0], prompt=PROMPT.format("what is the date"))
+    assert output["state_cache"]["encoder"]
+    assert output["state_cache"]["prefill_tokens"] == 0
+
+
+def test_prefill_matches_full_prompt(model):
+    torch.manual_seed(0)
+    encoder_states = torch.randn(1, 8, model.decoder.model.config.d_model)
+    input_ids = model.decoder.tokenizer(PROMPT.format("total amount"), add_special_tokens=False,
+                                        return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        empty = tuple((key[:, :, :0], value[:, :, :0], key, value)
+                      for key, value in model.decoder.cross_key_values(encoder_states))
+        full = model.decoder.prefill(input_ids, encoder_states, empty)
+        chunked = model.decoder.prefill(input_ids[:, :3], encoder_states, empty)
+        chunked = model.decoder.prefill(input_ids[:, 3:], encoder_states, chunked)
+    assert model.decoder.prefill(input_ids[:, :0], encoder_states, empty) is empty
+    for full_layer, chunked_layer in zip(full, chunked):
+        assert full_layer[0].shape[2] == input_ids.shape[1]
+        assert all(torch.allclose(a, b, rtol=1e-4, atol=1e-4) for a, b in zip(full_layer, chunked_layer))
+
+
+def test_get_prefix_longest_wins():
+    cache = DecoderStateCache(max_images=2, max_prefixes=8)
+    entry = cache.put("image", torch.zeros(1), [])
+    cache.put_prefix(entry, ((1, 2),), "short")
+    cache.put_prefix(entry, ((1, 2, 3, 4),), "long")
+    cache.put_prefix(entry, ((1, 2, 5),), "other")
+
+    assert cache.get_prefix(entry, ((1, 2, 3, 4, 6),)) == (4, "long")
+    assert cache.get_prefix(entry, ((1, 2, 3),)) == (2, "short")
+    assert cache.get_prefix(entry, ((1, 2, 5, 3),)) == (3, "other")
+    assert cache.get_prefix(entry, ((7, 2),)) == (0, None)
+    # cached states have a batch size: a prefix of a single prompt is not reused for a batch
+    assert cache.get_prefix(entry, ((1, 2, 3, 4), (1, 2, 3, 4))) == (0, None)
+    cache.put_prefix(entry, ((1, 2), (1, 3)), "batch")
+    assert cache.get_prefix(entry, ((1, 2, 4), (1, 3, 4))) == (2, "batch")
+    # every row of a batch must match
+    assert cache.get_prefix(entry, ((1, 2, 4), (1, 4, 4))) == (0, None)
+
+
+def test_lru_eviction():
+    cache = DecoderStateCache(max_images=2, max_prefixes=2)
+    first = cache.put("a", torch.zeros(1), [])
+    cache.put("b", torch.zeros(1), [])
+    assert cache.get("a") is first
+    cache.put("c", torch.zeros(1), [])
+    assert cache.get("b") is None and cache.get("a") is first
+
+    cache.put_prefix(first, ((1,),), "one")
+    cache.put_prefix(first, ((1, 2),), "two")
+    assert cache.get_prefix(first, ((1, 5),)) == (1, "one")  # refreshes (1,)
+    cache.put_prefix(first, ((3,),), "three")
+    assert list(first["prefixes"]) == [((1,),), ((3,),)]
+
+    cache.resize(1)
+    assert cache.get("c") is None and cache.get("a") is first